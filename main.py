@@ -1,10 +1,11 @@
 import logging
 from dotenv import load_dotenv
-from app import launch_demo
 
-# 加载配置文件
+# 加载配置文件，必须在导入 app 之前完成，各模块在导入时读取的配置项才能从 config.env 生效
 load_dotenv('config.env')
 
+from app import launch_demo  # noqa: E402
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
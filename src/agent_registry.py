@@ -0,0 +1,54 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable
+
+
+class AgentRegistry:
+    """
+    线程安全的代理注册表，按 模型/工具/提示词 配置缓存编译好的执行器，
+    同一配置只构建一次，在所有 Gradio worker 之间共享。
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = super().__new__(cls)
+                cls._instance._init_registry()
+            return cls._instance
+
+    def _init_registry(self):
+        self._agents: Dict[Hashable, Any] = {}
+        self._build_locks: Dict[Hashable, threading.Lock] = {}
+        self._registry_lock = threading.Lock()
+        self.build_seconds: Dict[Hashable, float] = {}
+
+    def get_or_create(self, key: Hashable, builder: Callable[[], Any]) -> Any:
+        """返回 key 对应的执行器，不存在时调用 builder 构建，并发请求只会构建一次"""
+        agent = self._agents.get(key)
+        if agent is not None:
+            return agent
+
+        with self._registry_lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:
+            agent = self._agents.get(key)
+            if agent is None:
+                start = time.perf_counter()
+                agent = builder()
+                self.build_seconds[key] = time.perf_counter() - start
+                self._agents[key] = agent
+                logging.info(f"代理执行器构建完成, 耗时 {self.build_seconds[key]:.3f}s")
+            return agent
+
+    def clear(self):
+        with self._registry_lock:
+            self._agents.clear()
+            self._build_locks.clear()
+            self.build_seconds.clear()
+
+
+agent_registry = AgentRegistry()
@@ -0,0 +1,158 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from embedding_service import get_embeddings, DEFAULT_EMBEDDING_MODEL
+from hybrid_retriever import tokenize
+
+# 问题向量余弦相似度不低于该阈值时视为同一问题
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.92))
+# 匹配问题所用的向量模型，中文问题建议换成中文或多语种模型
+ANSWER_CACHE_EMBEDDING_MODEL = os.getenv('ANSWER_CACHE_EMBEDDING_MODEL', DEFAULT_EMBEDDING_MODEL)
+# 词面校验：两个问题实词集合的 Jaccard 重合度下限，默认要求实词完全一致，
+# 避免只差一个实体(如"北京"与"上海")的问题因向量相近而误命中
+ANSWER_CACHE_MIN_JACCARD = float(os.getenv('ANSWER_CACHE_MIN_JACCARD', 1.0))
+# 缓存答案的有效期(秒)与最多保留的条目数
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 60 * 60))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 512))
+
+
+class CachedAnswer:
+    def __init__(self, question: str, vector: np.ndarray, answer: str, sources: List[str],
+                 collection: str, version: int, seconds: float):
+        self.question = question
+        self.terms = frozenset(tokenize(question))
+        self.vector = vector
+        self.answer = answer
+        self.sources = sources
+        self.collection = collection
+        self.version = version
+        # 生成该答案实际花费的时间，命中时计入节省的耗时
+        self.seconds = seconds
+        self.created = time.monotonic()
+
+
+class AnswerCache:
+    """
+    RAG 语义答案缓存：按独立问题的向量相似度匹配之前回答过的问题，并校验两者的实词集合，
+    命中时直接返回答案与来源。
+    每个向量库集合有一个版本号，文档入库会提升版本并清空该集合的缓存；
+    查询时记下版本号，写入时版本已变化的答案不会被缓存。条目按 TTL 过期、按 LRU 淘汰。
+    """
+
+    def __init__(self, embedding_model: str = ANSWER_CACHE_EMBEDDING_MODEL, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 min_jaccard: float = ANSWER_CACHE_MIN_JACCARD, ttl: float = ANSWER_CACHE_TTL,
+                 max_size: int = ANSWER_CACHE_SIZE):
+        self.embeddings = get_embeddings(embedding_model)
+        self.threshold = threshold
+        self.min_jaccard = min_jaccard
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._versions = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _lexically_equal(self, terms: frozenset, other: frozenset) -> bool:
+        union = terms | other
+        if not union:
+            return True
+        return len(terms & other) / len(union) >= self.min_jaccard
+
+    def version(self, collection: str) -> int:
+        with self._lock:
+            return self._versions.get(collection, 0)
+
+    def lookup(self, question: str, collection: str) -> Optional[CachedAnswer]:
+        """查找与问题语义相同且仍然有效的答案，未命中返回 None"""
+        vector = self._embed(question)
+        terms = frozenset(tokenize(question))
+        with self._lock:
+            self._expire()
+            version = self._versions.get(collection, 0)
+            candidates = [(key, entry) for key, entry in self._entries.items()
+                          if entry.collection == collection and entry.version == version]
+            best_key, best_score = None, self.threshold
+            if candidates:
+                scores = np.stack([entry.vector for _, entry in candidates]) @ vector
+                for index in np.argsort(-scores):
+                    if scores[index] < self.threshold:
+                        break
+                    # 向量相近还需通过词面校验，取第一个通过的候选
+                    if self._lexically_equal(terms, candidates[index][1].terms):
+                        best_key, best_score = candidates[index][0], float(scores[index])
+                        break
+            if best_key is None:
+                self.misses += 1
+                return None
+            entry = self._entries[best_key]
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            self.saved_seconds += entry.seconds
+        logging.info(f"答案缓存命中: {question!r} -> {entry.question!r} (相似度 {best_score:.3f})")
+        return entry
+
+    def store(self, question: str, answer: str, sources: List[str], collection: str, version: int,
+              seconds: float = 0.0) -> bool:
+        """缓存答案，version 为生成答案前取得的集合版本，期间有文档入库时放弃缓存"""
+        if not answer:
+            return False
+        vector = self._embed(question)
+        with self._lock:
+            if version != self._versions.get(collection, 0):
+                self.rejected += 1
+                return False
+            self._entries[self._next_id] = CachedAnswer(question, vector, answer, list(sources), collection,
+                                                        version, seconds)
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, collection: str) -> int:
+        """集合内容发生变化：提升版本号并删除该集合的全部缓存答案，返回删除数量"""
+        with self._lock:
+            self._versions[collection] = self._versions.get(collection, 0) + 1
+            stale = [key for key, entry in self._entries.items() if entry.collection == collection]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry.created < deadline]
+        for key in expired:
+            del self._entries[key]
+        self.evictions += len(expired)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+                "saved_seconds": self.saved_seconds,
+            }
+
+
+answer_cache = AnswerCache()
@@ -1,122 +1,379 @@
 import os
+import time
+import uuid
+import asyncio
+import queue
 import logging
+import threading
 import gradio as gr
 from gradio import ChatMessage
-from langchain_core.messages import HumanMessage
-from rag import initialize_rag_system, add_document_by_url, add_document_by_pdf
-from base_model import initialize_base_model, base_model_invoke
-from music_agent import music_agent
-from session_manager import SessionManager
-from tts import TTS
-
-# 初始化共享资源和配置参数
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk
+from rag import initialize_rag_system, add_document_by_url, add_document_by_pdf, needs_rewrite
+from base_model import initialize_base_model, base_model_stream
+from session_manager import SessionManager, SESSION_IDLE_TIMEOUT
+from answer_cache import answer_cache
+from startup import StartupManager
+from tools.music_tool.download_queue import download_queue, DOWNLOAD_WORKERS
+
+
+def load_music_agent():
+    from music_agent import music_agent
+    return music_agent()
+
+
+def load_tts():
+    from tts import TTS
+    return TTS()
+
+
+def load_email_scheduler():
+    # 启动调度器以便补发持久化的定时邮件
+    from tools.email_tool.email_tool import get_scheduler
+    return get_scheduler()
+
+
+# 初始化共享资源和配置参数，重型组件登记到启动管理器，在后台并行预热或首次使用时加载
 session_manager = SessionManager()
-base_model = initialize_base_model()
-conversational_rag_chain, vectorstore = initialize_rag_system(session_manager)
-music_agent_instance = music_agent()
-config = {'configurable': {'session_id': os.getenv('SESSION_ID')}}
-tts_instance = TTS()
+startup = StartupManager()
+startup.register("base_model", initialize_base_model)
+startup.register("rag", lambda: initialize_rag_system(session_manager))
+startup.register("music_agent", load_music_agent)
+startup.register("tts", load_tts)
+startup.register("email_scheduler", load_email_scheduler)
+# 会话回收检查间隔(秒)
+SESSION_GC_INTERVAL = int(os.getenv('SESSION_GC_INTERVAL', 60))
+
+
+def rag_chain():
+    return startup.get("rag")[0]
+
+
+def get_vectorstore():
+    return startup.get("rag")[1]
+
+
+def get_music_agent():
+    return startup.get("music_agent")
+
+
+class SilentPipeline:
+    """TTS 尚未就绪时使用的空语音流水线，回答照常显示但不合成语音"""
+
+    def feed(self, text: str):
+        pass
+
+    def close(self):
+        pass
+
+    def next_chunk(self):
+        return None
+
+    def remaining_chunks(self):
+        return iter(())
+
+
+def speech_pipeline():
+    """TTS 已就绪时返回语音流水线，否则返回空流水线，文字回复不等待 TTS 模型加载"""
+    tts = startup.peek("tts")
+    if tts is None:
+        logging.info("TTS 尚未就绪, 本次回复不合成语音")
+        return SilentPipeline()
+    return tts.pipeline()
+
+
+def get_session_id(request: gr.Request = None) -> str:
+    """以浏览器会话标识作为会话 ID，没有请求上下文时回退到配置中的 SESSION_ID"""
+    if request is not None and request.session_hash:
+        return request.session_hash
+    return os.getenv('SESSION_ID')
+
+
+# 页面会话标识 -> 浏览器持久的客户端 ID，页面关闭时据此释放内存中的聊天历史
+_client_ids = {}
+_client_ids_lock = threading.Lock()
+
 
+def ensure_client_id(client_id: str, request: gr.Request) -> str:
+    """
+    页面加载时取出保存在浏览器本地的客户端 ID，没有则新建。
+    session_hash 每次刷新页面都会变化，持久化的聊天历史以客户端 ID 为键，刷新后仍能读回。
+    """
+    client_id = client_id or uuid.uuid4().hex
+    with _client_ids_lock:
+        _client_ids[get_session_id(request)] = client_id
+    return client_id
 
-def ask_question(question: str) -> str:
-    """调用 RAG 系统回答问题"""
-    response = conversational_rag_chain.invoke({"input": question}, config=config)
-    answer = response.get("answer", "").replace("\n", "")
-    return answer
+
+def get_history_id(client_id: str, request: gr.Request = None) -> str:
+    """聊天历史使用的会话 ID：优先使用浏览器持久的客户端 ID"""
+    return client_id or get_session_id(request)
+
+
+def log_first_token(stream, label: str):
+    """透传流式输出，并记录首个片段到达时间(time-to-first-token)与总耗时"""
+    start = time.perf_counter()
+    first = True
+    for chunk in stream:
+        if first:
+            logging.info(f"{label} 首个片段耗时: {time.perf_counter() - start:.3f}s")
+            first = False
+        yield chunk
+    logging.info(f"{label} 流式输出总耗时: {time.perf_counter() - start:.3f}s")
+
+
+def standalone_question(question: str, session_id: str):
+    """原问题无需结合历史重写时本身就是独立问题，可以用于答案缓存匹配，否则返回 None"""
+    if needs_rewrite(question, session_manager.get_session_history(session_id).messages):
+        return None
+    return question
+
+
+def stream_question(question: str, session_id: str):
+    """
+    流式调用 RAG 系统，逐个产出回答的文本片段。
+    独立问题先查询语义答案缓存，命中时直接产出缓存的答案，未命中时生成完毕后写入缓存。
+    """
+    collection = get_vectorstore()._collection.name
+    standalone = standalone_question(question, session_id)
+    if standalone:
+        cached = answer_cache.lookup(standalone, collection)
+        if cached:
+            # 命中缓存同样记入会话历史，保证后续追问能引用这一轮对话
+            session_manager.get_session_history(session_id).add_messages(
+                [HumanMessage(content=question), AIMessage(content=cached.answer)])
+            logging.info(f"答案缓存来源: {cached.sources}, 统计: {answer_cache.stats()}")
+            yield cached.answer.replace("\n", "")
+            return
+        version = answer_cache.version(collection)
+    start = time.perf_counter()
+    config = {'configurable': {'session_id': session_id}}
+    answer, sources = "", []
+    for chunk in rag_chain().stream({"input": question}, config=config):
+        if chunk.get("context"):
+            sources = list(dict.fromkeys(doc.metadata.get("source") for doc in chunk["context"]))
+        text = chunk.get("answer")
+        if text:
+            answer += text
+            yield text.replace("\n", "")
+    if standalone:
+        answer_cache.store(standalone, answer, sources, collection, version, time.perf_counter() - start)
+        logging.info(f"答案缓存统计: {answer_cache.stats()}")
 
 
 def return_none():
     return None
 
 
-def add_document_by_url_chroma(url: str, classname: str) -> str:
-    """通过 URL 上传文档到向量库"""
+async def add_document_by_url_chroma(url: str, classname: str):
+    """通过 URL 上传文档到向量库，并实时产出入库进度"""
+    if not classname:
+        yield "classname为必填字段"
+        return
     try:
-        if classname:
-            add_document_by_url(url, vectorstore, classname)
-            return "文档提交成功"
-        return "classname为必填字段"
+        async for status in add_document_by_url(url, await asyncio.to_thread(get_vectorstore), classname):
+            yield status
     except Exception as e:
         logging.exception("add_document_by_url_chroma出错")
-        return str(e)
+        yield str(e)
 
 
-async def add_document_by_pdf_chroma(pdf_path: str) -> str:
-    """通过 PDF 上传文档到向量库"""
+async def add_document_by_pdf_chroma(pdf_path: str):
+    """通过 PDF 上传文档到向量库，并实时产出入库进度"""
     try:
-        await add_document_by_pdf(pdf_path, vectorstore)
-        return "文档提交成功"
+        async for status in add_document_by_pdf(pdf_path, await asyncio.to_thread(get_vectorstore)):
+            yield status
     except Exception as e:
         logging.exception("add_document_by_pdf_chroma出错")
-        return str(e)
+        yield str(e)
 
 
 def get_similar_score(question: str) -> str:
     """查询与输入问题相似的文档及相似度得分"""
+    vectorstore = get_vectorstore()
     results = vectorstore.similarity_search_with_score(question, k=4)
     text = ""
     for doc, score in results:
         text += "文档:" + doc.page_content[:100] + " 相似度得分:" + str(score) + "\n"
+    logging.info(f"向量化缓存统计: {vectorstore.embeddings.stats()}")
     return text
 
 
-def download_music(question: str) -> (str, str):
-    """调用音乐代理下载音乐，并返回回复文本和音乐文件路径"""
-    resp = music_agent_instance.invoke(
-        {'messages': [HumanMessage(content=question)]},
-        {"configurable": {"thread_id": os.getenv('SESSION_ID')}},
-    )
-    message = resp["messages"][-1]
+def stream_music(question: str, session_id: str):
+    """
+    流式调用音乐代理，产出 ("token", 文本片段) 与最终的 ("final", (回复文本, 音乐文件路径))。
+    代理内部可能有多轮模型生成，新一轮生成开始时以 ("reset", None) 通知调用方清空已显示的片段。
+    """
+    message_id = None
+    final_state = None
+    for mode, data in get_music_agent().stream(
+            {'messages': [HumanMessage(content=question)]},
+            {"configurable": {"thread_id": session_id}},
+            stream_mode=["messages", "values"],
+    ):
+        if mode == "values":
+            final_state = data
+            continue
+        chunk, _ = data
+        if not isinstance(chunk, AIMessageChunk) or not chunk.content:
+            continue
+        if chunk.id != message_id:
+            message_id = chunk.id
+            yield "reset", None
+        yield "token", chunk.content
+
+    messages = final_state["messages"] if final_state else []
     file_path = None
-    for msg in reversed(resp["messages"]):
+    for msg in reversed(messages):
         if msg.name == "download_music_tool" and "音乐文件保存本地路径:" in msg.content:
             file_path = msg.content.split("音乐文件保存本地路径:")[1]
             break
-    return message.content, file_path
+    yield "final", (messages[-1].content if messages else "", file_path)
 
 
-def rag_respond(message: str, history: list) -> (str, list, str):
-    """RAG 模式回复，将问题传递给 RAG 系统并更新历史记录"""
-    bot_message = ask_question(message)
-    history.append(ChatMessage(role="user", content=message))
-    history.append(ChatMessage(role="assistant", content=bot_message))
-    return "", history, bot_message
+def stream_music_with_status(question: str, session_id: str):
+    """
+    在后台线程中运行音乐代理，等待期间按会话产出下载任务进度 ("status", 文本)，
+    其余事件与 stream_music 相同，界面在下载过程中保持响应。
+    """
+    events = queue.Queue()
+
+    def produce():
+        try:
+            for event in stream_music(question, session_id):
+                events.put(event)
+        except Exception as e:
+            events.put(("error", e))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        try:
+            event = events.get(timeout=0.5)
+        except queue.Empty:
+            if not startup.is_ready("music_agent"):
+                yield "status", "音乐代理加载中..."
+                continue
+            jobs = download_queue.jobs_for(session_id)
+            if jobs:
+                yield "status", "，".join(job.describe() for job in jobs)
+            continue
+        if event is None:
+            return
+        if event[0] == "error":
+            raise event[1]
+        yield event
+
+
+def cancel_download(request: gr.Request):
+    """取消当前会话的全部下载任务"""
+    count = download_queue.cancel(get_session_id(request))
+    logging.info(f"已取消 {count} 个下载任务")
 
 
-def music_respond(message: str, history: list) -> (str, list, str, str):
-    """音乐模式回复，调用音乐代理并更新历史记录"""
-    bot_message, file_path = download_music(message)
+def release_session(request: gr.Request):
+    """
+    浏览器页面关闭时释放该页面占用的内存：聊天历史只从内存移除，SQLite 中的记录保留，
+    刷新后按客户端 ID 读回，长期不活跃的由 SESSION_RETENTION 清理；同时释放检查点并取消下载任务。
+    """
+    session_id = get_session_id(request)
+    with _client_ids_lock:
+        client_id = _client_ids.pop(session_id, None)
+    session_manager.release(client_id or session_id)
+    agent = startup.peek("music_agent")
+    if agent is not None:
+        agent.checkpointer.release(session_id)
+    download_queue.cancel(session_id)
+
+
+def collect_idle_sessions():
+    """后台定期回收空闲会话，使内存随在线用户数而不是累计请求量增长"""
+    while True:
+        time.sleep(SESSION_GC_INTERVAL)
+        try:
+            sessions = session_manager.collect_idle()
+            agent = startup.peek("music_agent")
+            threads = agent.checkpointer.collect_idle(SESSION_IDLE_TIMEOUT) if agent is not None else 0
+            if sessions or threads:
+                logging.info(f"已回收空闲会话 {sessions} 个, 音乐代理线程 {threads} 个")
+        except Exception:
+            logging.exception("回收空闲会话出错")
+
+
+def stream_chat(message: str, history: list, stream):
+    """
+    将流式片段逐步写入聊天历史，同时按句送入 TTS 流水线，
+    产出 (聊天历史, 语音片段)，没有新合成的语音时语音片段为 None。
+    """
+    pipeline = speech_pipeline()
     history.append(ChatMessage(role="user", content=message))
-    history.append(ChatMessage(role="assistant", content=bot_message))
-    return "", history, file_path, bot_message
+    history.append(ChatMessage(role="assistant", content=""))
+    bot_message = ""
+    try:
+        for token in stream:
+            bot_message += token
+            pipeline.feed(token)
+            history[-1] = ChatMessage(role="assistant", content=bot_message)
+            yield history, pipeline.next_chunk()
+    finally:
+        pipeline.close()
+    yield history, None
+    for chunk in pipeline.remaining_chunks():
+        yield history, chunk
+
+
+def rag_respond(message: str, history: list, client_id: str, request: gr.Request):
+    """RAG 模式回复，将问题传递给 RAG 系统并流式更新历史记录与语音"""
+    stream = log_first_token(stream_question(message, get_history_id(client_id, request)), "RAG")
+    for history, audio_chunk in stream_chat(message, history, stream):
+        yield "", history, audio_chunk
 
 
-def base_model_respond(message: str, history: list) -> (str, list, str):
-    """调用基础语言模型回复，并更新聊天历史"""
-    bot_message = base_model_invoke(message)
+def music_respond(message: str, history: list, request: gr.Request):
+    """音乐模式回复，流式调用音乐代理并更新历史记录，回复完成后合成语音"""
     history.append(ChatMessage(role="user", content=message))
-    history.append(ChatMessage(role="assistant", content=bot_message))
-    return "", history, bot_message
-
-
-def trans_text(gen_text: str):
-    """处理生成文本，并调用 TTS 生成语音"""
-    if gen_text:
-        if "<think>" in gen_text:
-            if "</think>" in gen_text:
-                gen_text = gen_text.split("</think>")[-1].replace("\n", "")
-                if not gen_text:
-                    return None
-            else:
-                return None
-    else:
-        return None
-    return tts_instance.generate(gen_text)
+    history.append(ChatMessage(role="assistant", content=""))
+    bot_message, file_path, status = "", None, ""
+    stream = log_first_token(stream_music_with_status(message, get_session_id(request)), "音乐")
+    for kind, data in stream:
+        if kind == "status":
+            status = data
+        elif kind == "reset":
+            bot_message, status = "", ""
+        elif kind == "token":
+            bot_message, status = bot_message + data, ""
+        else:
+            (bot_message, file_path), status = data, ""
+        history[-1] = ChatMessage(role="assistant", content=bot_message or status)
+        yield "", history, None, None
+    yield "", history, file_path, None
+    pipeline = speech_pipeline()
+    pipeline.feed(bot_message)
+    for chunk in pipeline.remaining_chunks():
+        yield "", history, gr.update(), chunk
+
+
+def base_model_respond(message: str, history: list, request: gr.Request):
+    """调用基础语言模型流式回复，并更新聊天历史与语音"""
+    stream = log_first_token(base_model_stream(message, get_session_id(request)), "AI")
+    for history, audio_chunk in stream_chat(message, history, stream):
+        yield "", history, audio_chunk
+
+
+def startup_status():
+    """返回各组件的加载状态，全部加载完成后停止定时刷新"""
+    return startup.report(), gr.Timer(active=not startup.finished())
 
 
 def launch_demo():
-    """构建 Gradio 前端界面并启动服务"""
+    """构建 Gradio 前端界面并启动服务，重型组件在后台预热，界面无需等待"""
+    startup.start()
     with gr.Blocks() as demo:
+        # 浏览器本地保存的客户端 ID，跨页面刷新保持不变
+        client_id = gr.BrowserState("", storage_key="local_agent_client_id")
+        with gr.Accordion("组件状态", open=False):
+            startup_text = gr.TextArea(label="加载状态与耗时", lines=6, interactive=False)
+        startup_timer = gr.Timer(2)
         # 用户输入区域
         with gr.Row():
             with gr.Column():
@@ -154,32 +411,38 @@ def launch_demo():
                 button5 = gr.Button(value="发送", variant="primary")
                 button6 = gr.Button(value="清空用户输入", variant="stop")
                 button7 = gr.Button(value="清空音乐", variant="stop")
+                button8 = gr.Button(value="取消下载", variant="stop")
 
         with gr.Row():
             with gr.Column():
                 chatbot = gr.Chatbot(type="messages", show_copy_all_button=True, height=600)
 
-        hidden_ai_resp = gr.Textbox(visible=False, interactive=False)
-        hidden_ai_audio = gr.Audio(visible=False, interactive=False, autoplay=True, show_download_button=False)
+        hidden_ai_audio = gr.Audio(visible=False, interactive=False, autoplay=True, streaming=True,
+                                   show_download_button=False)
 
         # 按钮事件绑定
         button1.click(fn=return_none, outputs=hidden_ai_audio) \
             .then(fn=get_similar_score, inputs=textarea1, outputs=textarea3) \
-            .then(fn=rag_respond, inputs=[textarea1, chatbot], outputs=[textarea1, chatbot, hidden_ai_resp]) \
-            .success(fn=trans_text, inputs=hidden_ai_resp, outputs=hidden_ai_audio)
+            .then(fn=rag_respond, inputs=[textarea1, chatbot, client_id], outputs=[textarea1, chatbot, hidden_ai_audio])
         button2.click(fn=return_none, outputs=textarea1)
         url_submit.click(fn=add_document_by_url_chroma, inputs=[url_input, class_input], outputs=url_status)
         pdf_submit.click(fn=add_document_by_pdf_chroma, inputs=pdf_input, outputs=pdf_status)
         button5.click(fn=return_none, outputs=audio) \
             .then(fn=return_none, outputs=hidden_ai_audio) \
-            .then(fn=music_respond, inputs=[textarea1, chatbot], outputs=[textarea1, chatbot, audio, hidden_ai_resp]) \
-            .success(fn=trans_text, inputs=hidden_ai_resp, outputs=hidden_ai_audio)
+            .then(fn=music_respond, inputs=[textarea1, chatbot], outputs=[textarea1, chatbot, audio, hidden_ai_audio],
+                  concurrency_limit=DOWNLOAD_WORKERS)
         button6.click(fn=return_none, outputs=textarea1)
         button7.click(fn=return_none, outputs=audio)
+        button8.click(fn=cancel_download)
         button3.click(fn=return_none, outputs=audio) \
             .then(fn=return_none, outputs=hidden_ai_audio) \
-            .then(fn=base_model_respond, inputs=[textarea1, chatbot], outputs=[textarea1, chatbot, hidden_ai_resp]) \
-            .success(fn=trans_text, inputs=hidden_ai_resp, outputs=hidden_ai_audio)
+            .then(fn=base_model_respond, inputs=[textarea1, chatbot], outputs=[textarea1, chatbot, hidden_ai_audio])
         button4.click(fn=return_none, outputs=textarea1)
+        demo.load(fn=ensure_client_id, inputs=client_id, outputs=client_id)
+        demo.unload(release_session)
+        demo.load(fn=startup_status, outputs=[startup_text, startup_timer])
+        startup_timer.tick(fn=startup_status, outputs=[startup_text, startup_timer])
+
+    threading.Thread(target=collect_idle_sessions, name="session-gc", daemon=True).start()
 
     demo.launch(allowed_paths=[r"."], server_name='0.0.0.0', server_port=80)
@@ -4,40 +4,60 @@ from langgraph.prebuilt import chat_agent_executor
 from tools.baidu_weather_tool.baidu_weather_tool import WeatherTool
 from tools.get_now_tool.get_now_tool import GetNowTool
 from tools.email_tool.email_tool import EmailTool
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import HumanMessage, AIMessageChunk
+from agent_registry import agent_registry
 
+BASE_MODEL_NAME = "qwen2.5:14b"
+BASE_MODEL_TOOLS = (WeatherTool, GetNowTool, EmailTool)
+BASE_MODEL_PROMPT = (
+    "请严格按照以下要求回答问题："
+    "1.使用中文回答问题，尽可能在回答中不要出现英文字母（如abc）"
+    "2.回答中所有阿拉伯数字必须转换为中文数字"
+    "例如：温度为10摄氏度，体感温度为9摄氏度，相对湿度为30%，北风为1级。需要改为：温度为十摄氏度，体感温度为九摄氏度，相对湿度为三十%，北风为一级。"
+    "3.不使用任何Markdown格式或代码框"
+    "保持回答自然流畅，符合中文表达习惯"
+    "现在请用纯文本格式回答我的问题："
+)
 
-def initialize_base_model():
+
+def build_base_model(model: str = BASE_MODEL_NAME, tool_classes=BASE_MODEL_TOOLS, prompt: str = BASE_MODEL_PROMPT):
     """
-    初始化基础语言模型，并配置调用工具，
+    构建基础语言模型执行器，并配置调用工具，
     要求回答时严格使用中文、转换数字格式且不使用 Markdown。
+    每次调用都会重新创建模型客户端、工具实例并编译执行图。
     """
 
-    llm = ChatOllama(model="qwen2.5:14b", temperature=0)
-    weather_tool = WeatherTool()
-    get_now_tool = GetNowTool()
-    email_tool = EmailTool()
-    tools = [weather_tool, get_now_tool, email_tool]
-
-    prompt = (
-        "请严格按照以下要求回答问题："
-        "1.使用中文回答问题，尽可能在回答中不要出现英文字母（如abc）"
-        "2.回答中所有阿拉伯数字必须转换为中文数字"
-        "例如：温度为10摄氏度，体感温度为9摄氏度，相对湿度为30%，北风为1级。需要改为：温度为十摄氏度，体感温度为九摄氏度，相对湿度为三十%，北风为一级。"
-        "3.不使用任何Markdown格式或代码框"
-        "保持回答自然流畅，符合中文表达习惯"
-        "现在请用纯文本格式回答我的问题："
-    )
+    llm = ChatOllama(model=model, temperature=0)
+    tools = [tool_class() for tool_class in tool_classes]
     agent_executor = chat_agent_executor.create_tool_calling_executor(llm, tools, state_modifier=prompt)
     return agent_executor
 
 
-def base_model_invoke(question: str) -> str:
+def initialize_base_model(model: str = BASE_MODEL_NAME, tool_classes=BASE_MODEL_TOOLS,
+                          prompt: str = BASE_MODEL_PROMPT):
+    """
+    获取基础语言模型执行器，同一 模型/工具/提示词 配置只构建一次并在请求间复用。
+    """
+
+    key = ("base_model", model, tuple(tool_class.__name__ for tool_class in tool_classes), prompt)
+    return agent_registry.get_or_create(key, lambda: build_base_model(model, tool_classes, prompt))
+
+
+def base_model_invoke(question: str, session_id: str = None) -> str:
     """调用基础语言模型处理问题"""
-    config = {'configurable': {'session_id': os.getenv('SESSION_ID')}}
+    config = {'configurable': {'session_id': session_id or os.getenv('SESSION_ID')}}
     resp = initialize_base_model().invoke({"messages": [HumanMessage(content=question)]}, config=config)
     if resp.get("messages"):
         message = resp["messages"][-1]
         return message.content.replace("\n", "")
     else:
         return ""
+
+
+def base_model_stream(question: str, session_id: str = None):
+    """流式调用基础语言模型，逐个产出回答的文本片段"""
+    config = {'configurable': {'session_id': session_id or os.getenv('SESSION_ID')}}
+    for chunk, metadata in initialize_base_model().stream({"messages": [HumanMessage(content=question)]},
+                                                          config=config, stream_mode="messages"):
+        if isinstance(chunk, AIMessageChunk) and chunk.content and metadata.get("langgraph_node") == "agent":
+            yield chunk.content.replace("\n", "")
@@ -0,0 +1,80 @@
+import argparse
+import logging
+import time
+from dotenv import load_dotenv
+
+
+def timeit(func, repeat: int) -> float:
+    """执行 func repeat 次，返回平均耗时(毫秒)"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_agent_setup(repeat: int):
+    """对比每次请求重新构建基础模型执行器与从注册表复用执行器的开销"""
+    from agent_registry import agent_registry
+    from base_model import build_base_model, initialize_base_model
+
+    agent_registry.clear()
+    rebuild_ms = timeit(build_base_model, repeat)
+    first_ms = timeit(initialize_base_model, 1)
+    cached_ms = timeit(initialize_base_model, repeat)
+    print(f"每次重新构建执行器: {rebuild_ms:.3f} ms/请求")
+    print(f"注册表首次构建:     {first_ms:.3f} ms")
+    print(f"注册表复用执行器:   {cached_ms:.4f} ms/请求")
+
+
+def bench_district_lookup(repeat: int):
+    """对比每次查询都解析 CSV 与使用常驻内存地区索引的查询延迟"""
+    from tools.baidu_weather_tool.baidu_weather_tool import DistrictIndex, DISTRICT_CSV_PATH, get_district_index
+
+    names = ["北京", "北京市朝阳区", "长春市朝阳区", "杭州西湖区", "广东省", "浦东新区"]
+    parse_ms = timeit(lambda: [DistrictIndex(DISTRICT_CSV_PATH).lookup(name) for name in names], repeat) / len(names)
+    index = get_district_index()
+    lookup_ms = timeit(lambda: [index.lookup(name) for name in names], repeat * 100) / len(names)
+    print(f"每次解析 CSV 查询: {parse_ms:.3f} ms/次")
+    print(f"常驻索引查询:      {lookup_ms:.4f} ms/次")
+
+
+def bench_cold_start(repeat: int):
+    """
+    测量冷启动：导入应用、后台并行预热组件，到基础模型产出首个回答片段与全部组件就绪的耗时。
+    冷启动每个进程只能测量一次，repeat 参数不生效。
+    """
+    start = time.perf_counter()
+    import app
+    import_s = time.perf_counter() - start
+    app.startup.start()
+    next(iter(app.base_model_stream("你好")), None)
+    first_response_s = time.perf_counter() - start
+    while not app.startup.finished():
+        time.sleep(0.1)
+    ready_s = time.perf_counter() - start
+    sequential_s = sum(info["seconds"] or 0 for info in app.startup.status().values())
+    print(f"导入应用(界面可启动): {import_s:.2f} s")
+    print(f"首个回答片段:         {first_response_s:.2f} s")
+    print(f"全部组件就绪:         {ready_s:.2f} s (逐个加载合计 {sequential_s:.2f} s)")
+    print(app.startup.report())
+
+
+BENCHMARKS = {
+    "agent_setup": bench_agent_setup,
+    "cold_start": bench_cold_start,
+    "district_lookup": bench_district_lookup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地微基准测试")
+    parser.add_argument("name", choices=sorted(BENCHMARKS), help="基准测试名称")
+    parser.add_argument("--repeat", type=int, default=20, help="重复次数")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args.repeat)
+
+
+if __name__ == '__main__':
+    load_dotenv('config.env')
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
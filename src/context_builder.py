@@ -0,0 +1,104 @@
+import os
+import re
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+from hybrid_retriever import tokenize
+from session_manager import estimate_tokens
+
+# 拼入提示词的检索上下文 token 上限
+RAG_CONTEXT_TOKENS = int(os.getenv('RAG_CONTEXT_TOKENS', 1200))
+# 判定相邻文本块重叠的最短/最长字符数(拆分器的重叠为 200 字符，切分点落在分隔符上会略有出入)
+MIN_OVERLAP = 20
+MAX_OVERLAP = 400
+
+SENTENCE_PATTERN = re.compile(r'[^。！？!?；;\n]*(?:[。！？!?；;\n]+|$)')
+
+
+def find_overlap(head: str, tail: str, min_overlap: int = MIN_OVERLAP, max_overlap: int = MAX_OVERLAP) -> int:
+    """返回 head 的结尾与 tail 的开头重叠的最大字符数，不足 min_overlap 时返回 0"""
+    for size in range(min(len(head), len(tail), max_overlap), min_overlap - 1, -1):
+        if head.endswith(tail[:size]):
+            return size
+    return 0
+
+
+def merge_pair(first: str, second: str) -> Optional[str]:
+    """两段文本互相包含或首尾重叠时返回合并后的文本，否则返回 None"""
+    if second in first:
+        return first
+    if first in second:
+        return second
+    overlap = find_overlap(first, second)
+    if overlap:
+        return first + second[overlap:]
+    overlap = find_overlap(second, first)
+    if overlap:
+        return second + first[overlap:]
+    return None
+
+
+def merge_overlapping(documents: List[Document]) -> List[List[str]]:
+    """
+    合并同一来源的文本块：被其他块完全包含的块直接丢弃，
+    首尾重叠的相邻块按重叠部分拼接成一段，返回按检索顺序排列的 [来源, 文本] 列表。
+    合并后的段落会继续与其余段落合并，直到不再变化，因此块的检索顺序不影响结果
+    (如依次检索到第 0、2、1 块时，第 1 块会把前两段连成一段)。
+    """
+    passages = []
+    for doc in documents:
+        source, text = doc.metadata.get("source"), doc.page_content
+        position = len(passages)
+        merged = True
+        while merged:
+            merged = False
+            for index, passage in enumerate(passages):
+                if passage[0] != source:
+                    continue
+                combined = merge_pair(passage[1], text)
+                if combined is not None:
+                    text = combined
+                    position = min(position, index)
+                    del passages[index]
+                    merged = True
+                    break
+        passages.insert(position, [source, text])
+    return passages
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_PATTERN.findall(text) if sentence.strip()]
+
+
+def assemble_context(question: str, documents: List[Document], budget: int = RAG_CONTEXT_TOKENS):
+    """
+    组装检索上下文：先去重并合并重叠的文本块，超出 token 预算时按与问题的词语重合度
+    (相同时优先排名靠前的段落)挑选句子，再按原文顺序拼接。返回 (上下文文本, 裁剪前 token 数)。
+    """
+    passages = [text for _, text in merge_overlapping(documents)]
+    total = sum(estimate_tokens(text) for text in passages)
+    if total <= budget:
+        return "\n\n".join(passages), total
+
+    question_terms = set(tokenize(question))
+    sentences = []
+    for rank, text in enumerate(passages):
+        for position, sentence in enumerate(split_sentences(text)):
+            overlap = len(question_terms & set(tokenize(sentence)))
+            sentences.append((overlap, -rank, rank, position, sentence))
+    chosen, used = [], 0
+    for overlap, _, rank, position, sentence in sorted(sentences, key=lambda item: item[:2], reverse=True):
+        tokens = estimate_tokens(sentence)
+        if used + tokens > budget:
+            continue
+        chosen.append((rank, position, sentence))
+        used += tokens
+    chosen.sort()
+    parts, last_rank = [], None
+    for rank, _, sentence in chosen:
+        if rank != last_rank:
+            parts.append("")
+            last_rank = rank
+        parts[-1] += sentence.strip()
+    return "\n\n".join(parts), total
@@ -0,0 +1,148 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import OllamaEmbeddings
+
+DEFAULT_EMBEDDING_MODEL = "all-minilm:l6-v2"
+EMBEDDING_CACHE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../embedding_cache.db'))
+
+
+class EmbeddingStore:
+    """
+    基于 SQLite 的向量键值存储，键为 (模型, 文本哈希)，值为紧凑的 float32 字节串。
+    """
+
+    def __init__(self, db_path: str = EMBEDDING_CACHE_PATH):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            self._conn.commit()
+
+    def get_many(self, model: str, hashes: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            # 分批查询，避免超出 SQLite 变量数量上限
+            for start in range(0, len(hashes), 500):
+                part = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN "
+                    f"({','.join('?' * len(part))})",
+                    [model, *part],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, items: dict):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model, text_hash, np.asarray(vector, dtype=np.float32).tobytes())
+                 for text_hash, vector in items.items()],
+            )
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带持久化缓存的向量化服务，命中时直接返回本地向量而不请求 Ollama，
+    并统计命中率与耗时。
+    """
+
+    def __init__(self, model: str = DEFAULT_EMBEDDING_MODEL, store: EmbeddingStore = None):
+        self.model = model
+        self.embeddings = OllamaEmbeddings(model=model)
+        self.store = store or EmbeddingStore()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.cache_seconds = 0.0
+        self.ollama_seconds = 0.0
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, texts: List[str]):
+        start = time.perf_counter()
+        hashes = [self.text_hash(text) for text in texts]
+        found = self.store.get_many(self.model, list(set(hashes)))
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in found:
+                missing[text_hash] = text
+        miss_count = sum(1 for text_hash in hashes if text_hash in missing)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.hits += len(texts) - miss_count
+            self.misses += miss_count
+            self.cache_seconds += elapsed
+        return hashes, found, missing
+
+    def _record(self, found: dict, missing: dict, vectors: List[List[float]], elapsed: float):
+        computed = dict(zip(missing.keys(), vectors))
+        self.store.put_many(self.model, computed)
+        for text_hash, vector in computed.items():
+            found[text_hash] = np.asarray(vector, dtype=np.float32)
+        with self._stats_lock:
+            self.ollama_seconds += elapsed
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, found, missing = self._lookup(texts)
+        if missing:
+            start = time.perf_counter()
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self._record(found, missing, vectors, time.perf_counter() - start)
+        return [found[text_hash].tolist() for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, found, missing = self._lookup(texts)
+        if missing:
+            start = time.perf_counter()
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            self._record(found, missing, vectors, time.perf_counter() - start)
+        return [found[text_hash].tolist() for text_hash in hashes]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "cache_seconds": self.cache_seconds,
+                "ollama_seconds": self.ollama_seconds,
+            }
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_embeddings(model: str = DEFAULT_EMBEDDING_MODEL) -> CachedEmbeddings:
+    """获取进程内共享的带缓存向量化服务，同一模型只创建一次"""
+    with _services_lock:
+        if model not in _services:
+            _services[model] = CachedEmbeddings(model)
+            logging.info(f"向量化缓存服务已创建: {model}")
+        return _services[model]
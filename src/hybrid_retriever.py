@@ -0,0 +1,241 @@
+import os
+import re
+import json
+import math
+import sqlite3
+import logging
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_chroma import Chroma
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:
+    jieba = None
+
+SPARSE_INDEX_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../rag_sparse_index.db'))
+# 最终返回的文档数、稠密/稀疏各自召回的候选数，以及倒数排名融合的平滑常数
+RAG_TOP_K = int(os.getenv('RAG_TOP_K', 3))
+RAG_FETCH_K = int(os.getenv('RAG_FETCH_K', 20))
+RRF_K = int(os.getenv('RAG_RRF_K', 60))
+# 本地交叉编码器重排模型(sentence-transformers)，为空时不重排
+RAG_RERANK_MODEL = os.getenv('RAG_RERANK_MODEL', '')
+
+TOKEN_PATTERN = re.compile(r'[\u4e00-\u9fff]+|[a-z0-9]+(?:\.[0-9]+)?')
+STOPWORDS = frozenset("的 了 是 在 和 与 及 或 就 都 而 也 把 被 对 从 为 以 之 着 吗 呢 吧 啊 "
+                      "a an the of to in on at for and or is are was be".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中英文混合分词：中文使用 jieba 搜索模式分词，未安装 jieba 时退化为相邻二字切分；
+    英文与数字按单词切分并转为小写，去除常见停用词。
+    """
+    tokens = []
+    for piece in TOKEN_PATTERN.findall(text.lower()):
+        if not '\u4e00' <= piece[0] <= '\u9fff':
+            tokens.append(piece)
+        elif jieba is not None:
+            tokens.extend(word for word in jieba.lcut_for_search(piece) if word.strip())
+        elif len(piece) == 1:
+            tokens.append(piece)
+        else:
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return [token for token in tokens if token not in STOPWORDS]
+
+
+class SparseIndex:
+    """
+    与 Chroma 集合并行维护的 BM25 稀疏索引。
+    分词结果持久化到 SQLite，启动时直接载入而无需重新分词；文档入库/删除时增量更新。
+    """
+
+    def __init__(self, collection: str, db_path: str = SPARSE_INDEX_PATH, k1: float = 1.5, b: float = 0.75):
+        self.collection = collection
+        self.k1 = k1
+        self.b = b
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._doc_terms: Dict[str, Counter] = {}
+        self._doc_len: Dict[str, int] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._total_len = 0
+        with self._lock:
+            self._conn.executescript(
+                "PRAGMA journal_mode=WAL;"
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "collection TEXT NOT NULL, id TEXT NOT NULL, terms TEXT NOT NULL, PRIMARY KEY (collection, id));"
+            )
+            rows = self._conn.execute("SELECT id, terms FROM chunks WHERE collection = ?", (collection,)).fetchall()
+            for chunk_id, terms in rows:
+                self._index(chunk_id, Counter(json.loads(terms)))
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def _index(self, chunk_id: str, terms: Counter):
+        self._doc_terms[chunk_id] = terms
+        length = sum(terms.values())
+        self._doc_len[chunk_id] = length
+        self._total_len += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+
+    def _unindex(self, chunk_id: str):
+        terms = self._doc_terms.pop(chunk_id, None)
+        if terms is None:
+            return
+        self._total_len -= self._doc_len.pop(chunk_id)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def add(self, ids: Sequence[str], texts: Sequence[str]):
+        """新增或更新文本块"""
+        counted = [(chunk_id, Counter(tokenize(text))) for chunk_id, text in zip(ids, texts)]
+        with self._lock:
+            for chunk_id, terms in counted:
+                self._unindex(chunk_id)
+                self._index(chunk_id, terms)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (collection, id, terms) VALUES (?, ?, ?)",
+                [(self.collection, chunk_id, json.dumps(terms, ensure_ascii=False)) for chunk_id, terms in counted],
+            )
+            self._conn.commit()
+
+    def delete(self, ids: Sequence[str]):
+        with self._lock:
+            for chunk_id in ids:
+                self._unindex(chunk_id)
+            self._conn.executemany("DELETE FROM chunks WHERE collection = ? AND id = ?",
+                                   [(self.collection, chunk_id) for chunk_id in ids])
+            self._conn.commit()
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """返回 BM25 得分最高的 k 个 (文本块 ID, 得分)"""
+        terms = set(tokenize(query))
+        with self._lock:
+            count = len(self._doc_terms)
+            if not count or not terms:
+                return []
+            avg_len = self._total_len / count or 1
+            scores = Counter()
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_len[chunk_id] / avg_len)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores.most_common(k)
+
+
+class CrossEncoderReranker:
+    """本地交叉编码器重排，按 (问题, 文本块) 的相关性得分重新排序候选文档"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name)
+        self._lock = threading.Lock()
+
+    def rerank(self, query: str, documents: List[Document], k: int) -> List[Document]:
+        if not documents:
+            return documents
+        with self._lock:
+            scores = self.model.predict([(query, doc.page_content) for doc in documents])
+        ranked = sorted(zip(documents, scores), key=lambda item: item[1], reverse=True)
+        return [doc for doc, _ in ranked[:k]]
+
+
+_indexes = {}
+_rerankers = {}
+_registry_lock = threading.Lock()
+
+
+def get_sparse_index(vectorstore: Chroma) -> SparseIndex:
+    """获取集合对应的稀疏索引，首次使用且索引为空时从 Chroma 中已有的文本块回填"""
+    collection = vectorstore._collection
+    with _registry_lock:
+        index = _indexes.get(collection.name)
+        if index is None:
+            index = SparseIndex(collection.name)
+            if not len(index) and collection.count():
+                offset = 0
+                while True:
+                    batch = collection.get(include=["documents"], limit=1000, offset=offset)
+                    if not batch["ids"]:
+                        break
+                    index.add(batch["ids"], batch["documents"])
+                    offset += len(batch["ids"])
+                logging.info(f"稀疏索引已从向量库回填 {len(index)} 个文本块")
+            _indexes[collection.name] = index
+        return index
+
+
+def get_reranker(model_name: str = RAG_RERANK_MODEL) -> Optional[CrossEncoderReranker]:
+    """获取共享的重排模型，未配置或未安装 sentence-transformers 时返回 None"""
+    if not model_name:
+        return None
+    with _registry_lock:
+        if model_name not in _rerankers:
+            try:
+                _rerankers[model_name] = CrossEncoderReranker(model_name)
+                logging.info(f"重排模型已加载: {model_name}")
+            except ImportError:
+                logging.warning("未安装 sentence-transformers, 跳过交叉编码器重排")
+                _rerankers[model_name] = None
+        return _rerankers[model_name]
+
+
+def document_key(doc: Document):
+    return doc.metadata.get("source"), doc.page_content
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    混合检索：稠密向量检索与 BM25 稀疏检索各召回 fetch_k 个候选，按倒数排名融合(RRF)，
+    配置了重排模型时再用交叉编码器精排，最终返回 k 个文档。
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: Chroma
+    sparse_index: SparseIndex
+    reranker: Optional[CrossEncoderReranker] = None
+    k: int = RAG_TOP_K
+    fetch_k: int = RAG_FETCH_K
+    rrf_k: int = RRF_K
+
+    def _sparse_documents(self, query: str) -> List[Document]:
+        hits = self.sparse_index.search(query, self.fetch_k)
+        if not hits:
+            return []
+        found = self.vectorstore._collection.get(ids=[chunk_id for chunk_id, _ in hits],
+                                                 include=["documents", "metadatas"])
+        by_id = {chunk_id: Document(id=chunk_id, page_content=text, metadata=metadata or {})
+                 for chunk_id, text, metadata in zip(found["ids"], found["documents"], found["metadatas"])}
+        return [by_id[chunk_id] for chunk_id, _ in hits if chunk_id in by_id]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        dense = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        sparse = self._sparse_documents(query)
+        scores, documents = Counter(), {}
+        for ranking in (dense, sparse):
+            for rank, doc in enumerate(ranking):
+                key = document_key(doc)
+                documents.setdefault(key, doc)
+                scores[key] += 1 / (self.rrf_k + rank + 1)
+        fused = [documents[key] for key, _ in scores.most_common()]
+        if self.reranker is not None:
+            return self.reranker.rerank(query, fused[:self.fetch_k], self.k)
+        return fused[:self.k]
@@ -1,18 +1,81 @@
+import os
+import time
+import uuid
+import logging
+import threading
 from langchain_ollama import ChatOllama
-from langgraph.prebuilt import chat_agent_executor
-from langchain_core.messages import ToolMessage
+from langgraph.prebuilt import chat_agent_executor, ToolNode
+from langchain_core.messages import ToolMessage, AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import END, StateGraph, add_messages
 from langgraph.checkpoint.memory import MemorySaver
 from tools.music_tool.analysis_music_url_tool import AnalysisMusicUrlTool
 from tools.music_tool.download_music_tool import DownloadMusicTool
+from tools.music_tool.music_library import music_library
 from typing import List, TypedDict, Annotated
 from langchain_core.messages import BaseMessage
 
 
-def music_agent():
+# 快速通道：最高相似度领先第二名超过该差值时，不再询问模型而直接下载
+FAST_PATH_MARGIN = float(os.getenv('MUSIC_FAST_PATH_MARGIN', 0.1))
+# 单次请求内下载节点最多执行的次数
+MAX_DOWNLOAD_ATTEMPTS = int(os.getenv('MUSIC_MAX_DOWNLOAD_ATTEMPTS', 3))
+
+
+class ExpiringMemorySaver(MemorySaver):
+    """
+    记录每个会话线程最后访问时间的内存检查点，可以释放指定线程或回收空闲线程，
+    使检查点内存随在线用户数而不是累计请求量增长。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_access = {}
+        # 图运行线程的读写与页面卸载/回收线程的释放共用同一把锁，避免遍历时字典被修改
+        self._access_lock = threading.RLock()
+
+    def _touch(self, config):
+        thread_id = config.get('configurable', {}).get('thread_id')
+        if thread_id is not None:
+            self._last_access[thread_id] = time.monotonic()
+
+    def get_tuple(self, config):
+        with self._access_lock:
+            self._touch(config)
+            return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self._access_lock:
+            self._touch(config)
+            return super().put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config, writes, task_id, *args, **kwargs):
+        with self._access_lock:
+            return super().put_writes(config, writes, task_id, *args, **kwargs)
+
+    def release(self, thread_id: str):
+        """删除某个会话线程的全部检查点"""
+        with self._access_lock:
+            self._last_access.pop(thread_id, None)
+            # 由检查点自身删除该线程的检查点、待写入记录与通道数据(消息列表保存在 blobs 中)
+            self.delete_thread(thread_id)
+
+    def collect_idle(self, max_idle: float) -> int:
+        """回收空闲超过 max_idle 秒的会话线程，返回回收数量"""
+        deadline = time.monotonic() - max_idle
+        with self._access_lock:
+            idle = [thread_id for thread_id, last in self._last_access.items() if last < deadline]
+        for thread_id in idle:
+            self.release(thread_id)
+        return len(idle)
+
+
+def music_agent(fast_path: bool = True, fast_path_margin: float = FAST_PATH_MARGIN,
+                max_download_attempts: int = MAX_DOWNLOAD_ATTEMPTS):
     """
     初始化音乐下载代理，使用两个工具：分析音乐链接和下载音乐。
-    根据分析结果决定是否调用下载工具，直至所有音乐下载成功。
+    根据分析结果决定是否调用下载工具，直至所有音乐下载成功或达到下载次数上限。
+    开启快速通道时，分析结果足够确定则直接调用下载工具，跳过模型选择链接的环节。
     """
 
     llm = ChatOllama(model="qwen2.5:14b", temperature=0)
@@ -43,16 +106,136 @@ def music_agent():
     )
     agent_executor = chat_agent_executor.create_tool_calling_executor(llm, tools, state_modifier=system_prompt)
 
+    llm_with_tools = llm.bind_tools(tools)
+    tool_node = ToolNode(tools)
+
     class AgentState(TypedDict):
         messages: Annotated[list, add_messages]
+        # 本次请求的模型调用、工具调用与下载次数统计
+        llm_calls: int
+        tool_calls: int
+        download_attempts: int
 
     workflow = StateGraph(AgentState)
 
-    def call_tool(state):
-        return agent_executor.invoke(state)
+    def count(state, new_messages):
+        """根据新增消息累计模型调用、工具调用与下载次数"""
+        tool_messages = [msg for msg in new_messages if isinstance(msg, ToolMessage)]
+        return {
+            'llm_calls': state.get('llm_calls', 0) + sum(isinstance(msg, AIMessage) for msg in new_messages),
+            'tool_calls': state.get('tool_calls', 0) + len(tool_messages),
+            'download_attempts': state.get('download_attempts', 0) + sum(
+                msg.name == tool2.name for msg in tool_messages),
+        }
+
+    def call_tool(state, config: RunnableConfig):
+        messages = state['messages']
+        result = agent_executor.invoke({'messages': messages}, config)
+        new_messages = result['messages'][len(messages):]
+        return {'messages': new_messages, **count(state, new_messages)}
 
-    workflow.add_node("analysis", call_tool)
-    workflow.add_node("download", call_tool)
+    def analyze(state, config: RunnableConfig):
+        """只做一轮 模型决策 + 工具执行，把是否继续交给后续路由决定"""
+        response = llm_with_tools.invoke([SystemMessage(content=system_prompt)] + state['messages'], config)
+        new_messages = [response]
+        if response.tool_calls:
+            new_messages += tool_node.invoke({'messages': state['messages'] + [response]}, config)['messages']
+        return {'messages': new_messages, **count(state, new_messages)}
+
+    def analysis_results(state):
+        """取出本轮分析工具返回的结构化候选列表"""
+        for msg in reversed(current_turn(state['messages'])):
+            if isinstance(msg, ToolMessage) and msg.name == tool1.name:
+                return msg.artifact or []
+        return []
+
+    def requested_song(state):
+        for msg in reversed(current_turn(state['messages'])):
+            if isinstance(msg, AIMessage):
+                for tool_call in msg.tool_calls:
+                    if tool_call['name'] == tool1.name:
+                        return tool_call['args'].get('song_name')
+        return None
+
+    def confident_choice(state):
+        results = analysis_results(state)
+        if not results:
+            return False
+        runner_up = results[1]['similarity'] if len(results) > 1 else float('-inf')
+        return results[0]['similarity'] - runner_up >= fast_path_margin
+
+    def fast_download(state, config: RunnableConfig):
+        """直接下载相似度明显领先的候选，成功时按模板回复"""
+        url = analysis_results(state)[0]['url']
+        tool_call_id = f"fast_{uuid.uuid4().hex[:8]}"
+        content = tool2.invoke({'url': url}, config)
+        new_messages = [
+            AIMessage(content="", tool_calls=[{"name": tool2.name, "args": {"url": url}, "id": tool_call_id}]),
+            ToolMessage(content=content, name=tool2.name, tool_call_id=tool_call_id),
+        ]
+        counters = count(state, new_messages)
+        # 合成的工具调用消息不是模型生成的
+        counters['llm_calls'] -= 1
+        if "所有音乐下载成功" in content:
+            new_messages.append(AIMessage(content=f"《{requested_song(state) or '歌曲'}》已就绪"))
+        return {'messages': new_messages, **counters}
+
+    def download(state, config: RunnableConfig):
+        # 模型没有调用下载工具时也计为一次尝试，保证下载循环一定会结束
+        result = call_tool(state, config)
+        result['download_attempts'] = max(result['download_attempts'], state.get('download_attempts', 0) + 1)
+        return result
+
+    def give_up(state):
+        return {'messages': [AIMessage(content="暂时无法获取该曲目")]}
+
+    def current_turn(messages: List[BaseMessage]):
+        """返回本轮请求(最后一条用户消息之后)的消息"""
+        for index in range(len(messages) - 1, -1, -1):
+            if isinstance(messages[index], HumanMessage):
+                return messages[index:]
+        return messages
+
+    def lookup_library(state):
+        """在调用任何网络或模型之前先查询本地音乐库，命中时直接给出结果"""
+        question = current_turn(state['messages'])[0].content
+        entry = music_library.match_query(question)
+        if not entry:
+            return {'messages': [], 'llm_calls': 0, 'tool_calls': 0, 'download_attempts': 0}
+        tool_call_id = f"library_{entry['video_id']}"
+        return {'messages': [
+            AIMessage(content="", tool_calls=[
+                {"name": tool2.name, "args": {"url": entry['url']}, "id": tool_call_id}
+            ]),
+            ToolMessage(content="所有音乐下载成功。" + "音乐文件保存本地路径:" + entry['path'],
+                        name=tool2.name, tool_call_id=tool_call_id),
+            AIMessage(content=f"《{entry['song']}》已就绪"),
+        ], 'llm_calls': 0, 'tool_calls': 0, 'download_attempts': 0}
+
+    def index_library(state):
+        """下载成功后把本轮分析时使用的歌名与歌手登记到音乐库"""
+        song, artist, path = None, None, None
+        for msg in current_turn(state['messages']):
+            if isinstance(msg, AIMessage):
+                for tool_call in msg.tool_calls:
+                    if tool_call['name'] == tool1.name:
+                        song = tool_call['args'].get('song_name')
+                        artist = tool_call['args'].get('artist')
+            elif (isinstance(msg, ToolMessage) and msg.name == tool2.name
+                  and "音乐文件保存本地路径:" in msg.content):
+                path = msg.content.split("音乐文件保存本地路径:")[1]
+        if song and path:
+            music_library.tag(path, song, artist)
+        logging.info(f"音乐请求统计: 模型调用 {state.get('llm_calls', 0)} 次, "
+                     f"工具调用 {state.get('tool_calls', 0)} 次, 下载 {state.get('download_attempts', 0)} 次")
+        return {'messages': []}
+
+    workflow.add_node("library", lookup_library)
+    workflow.add_node("analysis", analyze if fast_path else call_tool)
+    workflow.add_node("fast_download", fast_download)
+    workflow.add_node("download", download)
+    workflow.add_node("give_up", give_up)
+    workflow.add_node("index", index_library)
 
     def get_last_tool_message(messages: List[BaseMessage]):
         for msg in reversed(messages):
@@ -60,6 +243,9 @@ def music_agent():
                 return msg
         return None
 
+    def library_miss(state):
+        return isinstance(state['messages'][-1], HumanMessage)
+
     def should_end(state):
         messages = state['messages']
         last_tool_msg = get_last_tool_message(messages)
@@ -75,10 +261,31 @@ def music_agent():
         return (("找到以下备选下载链接" in last_tool_msg.content)
                 and ("https://www.bilibili.com/video/" in last_tool_msg.content))
 
-    workflow.add_conditional_edges("analysis", should_download, {True: "download", False: END})
-    workflow.add_conditional_edges("download", should_end, {True: END, False: "download"})
-    workflow.set_entry_point("analysis")
+    def route_analysis(state):
+        if not should_download(state):
+            return "index"
+        if fast_path and confident_choice(state):
+            return "fast_download"
+        return "download"
+
+    def route_download(state):
+        if should_end(state):
+            return "index"
+        if state.get('download_attempts', 0) >= max_download_attempts:
+            return "give_up"
+        return "download"
+
+    workflow.add_conditional_edges("library", library_miss, {True: "analysis", False: END})
+    workflow.add_conditional_edges("analysis", route_analysis,
+                                   {"download": "download", "fast_download": "fast_download", "index": "index"})
+    workflow.add_conditional_edges("fast_download", route_download,
+                                   {"index": "index", "download": "download", "give_up": "give_up"})
+    workflow.add_conditional_edges("download", route_download,
+                                   {"index": "index", "download": "download", "give_up": "give_up"})
+    workflow.add_edge("give_up", "index")
+    workflow.add_edge("index", END)
+    workflow.set_entry_point("library")
 
-    memory = MemorySaver()
+    memory = ExpiringMemorySaver()
     graph = workflow.compile(checkpointer=memory)
     return graph
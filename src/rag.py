@@ -1,15 +1,108 @@
 import os
+import time
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 import bs4
-from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_ollama import ChatOllama
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains.history_aware_retriever import create_history_aware_retriever
-from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains.retrieval import create_retrieval_chain
-from langchain_core.runnables import RunnableWithMessageHistory
-from src.session_manager import SessionManager
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableWithMessageHistory
+from session_manager import SessionManager, estimate_tokens
+from embedding_service import get_embeddings
+from answer_cache import answer_cache
+from hybrid_retriever import HybridRetriever, get_sparse_index, get_reranker, tokenize, RAG_TOP_K
+from context_builder import assemble_context, RAG_CONTEXT_TOKENS
+
+
+# 问题重写使用的小模型、等待重写结果的最长时间(秒)，以及视为依赖上下文的短追问 token 数
+REWRITE_MODEL = os.getenv('RAG_REWRITE_MODEL', 'qwen2.5:1.5b')
+REWRITE_TIMEOUT = float(os.getenv('RAG_REWRITE_TIMEOUT', 3))
+SHORT_QUESTION_TOKENS = int(os.getenv('RAG_SHORT_QUESTION_TOKENS', 4))
+# 指代或承接上文的词语，按分词结果整词匹配(避免"其他""应该""因此"中的单字误判)，出现时问题需要结合历史重写
+REFERENCE_WORDS = frozenset(
+    "它 他 她 它们 他们 她们 这个 那个 这些 那些 这里 那里 这样 那样 这种 那种 上面 上述 前面 刚才 之前 "
+    "其中 该 此 还有 另外 继续 "
+    "it its they them this that these those he she his her above previous".split()
+)
+_retrieval_pool = ThreadPoolExecutor(max_workers=int(os.getenv('RAG_RETRIEVAL_WORKERS', 8)),
+                                     thread_name_prefix="rag-retrieval")
+
+
+def needs_rewrite(question: str, chat_history) -> bool:
+    """
+    低成本判断问题是否需要结合历史重写：没有历史时不需要；
+    含有指代/承接用词，或是很短的追问(如"为什么？")时需要。
+    """
+    if not chat_history:
+        return False
+    if REFERENCE_WORDS.intersection(tokenize(question)):
+        return True
+    return estimate_tokens(question.strip()) <= SHORT_QUESTION_TOKENS
+
+
+def merge_documents(primary, secondary, k: int):
+    """按顺序合并两组检索结果并去重，最多保留 k 个"""
+    merged, seen = [], set()
+    for doc in list(primary) + list(secondary):
+        key = doc.id or doc.page_content
+        if key not in seen:
+            seen.add(key)
+            merged.append(doc)
+    return merged[:k]
+
+
+def build_contextual_retriever(retriever, rewrite_chain, k: int, timeout: float = REWRITE_TIMEOUT):
+    """
+    构建检索前端，输入 {"input", "chat_history"}，输出文档列表。
+    独立问题直接检索，不调用模型；需要重写时，原问题检索与小模型重写并行进行，
+    重写在 timeout 内完成则以重写后的问题检索为主、原问题结果补充，超时则直接使用原问题的结果。
+    """
+
+    def retrieve(inputs: dict):
+        question = inputs["input"]
+        chat_history = inputs.get("chat_history") or []
+        if not needs_rewrite(question, chat_history):
+            logging.info("问题无需重写, 直接检索")
+            return retriever.invoke(question)
+        start = time.perf_counter()
+        raw = _retrieval_pool.submit(retriever.invoke, question)
+        rewrite = _retrieval_pool.submit(rewrite_chain.invoke, {"input": question, "chat_history": chat_history})
+        try:
+            rewritten = rewrite.result(timeout=timeout).strip()
+        except FutureTimeoutError:
+            logging.info(f"问题重写超过 {timeout}s, 使用原问题的检索结果")
+            return raw.result()
+        except Exception:
+            logging.exception("问题重写失败, 使用原问题的检索结果")
+            return raw.result()
+        logging.info(f"问题重写耗时 {time.perf_counter() - start:.3f}s: {question!r} -> {rewritten!r}")
+        if not rewritten or rewritten == question:
+            return raw.result()
+        return merge_documents(retriever.invoke(rewritten), raw.result(), k)
+
+    return RunnableLambda(retrieve)
+
+
+def create_budgeted_qa_chain(llm, prompt: ChatPromptTemplate, budget: int = RAG_CONTEXT_TOKENS):
+    """
+    替代 create_stuff_documents_chain 的问答链：检索到的文档经过去重、合并与按句裁剪，
+    控制在 token 预算内再填入提示词，并记录每次请求的提示词 token 数。
+    """
+
+    def build_prompt(inputs: dict):
+        context, context_tokens = assemble_context(inputs["input"], inputs.get("context") or [], budget)
+        prompt_value = prompt.invoke({**inputs, "context": context})
+        prompt_tokens = sum(estimate_tokens(str(message.content)) for message in prompt_value.to_messages())
+        logging.info(f"RAG 提示词约 {prompt_tokens} tokens, 上下文 {context_tokens} -> {estimate_tokens(context)} tokens")
+        return prompt_value
+
+    return (RunnableLambda(build_prompt) | llm | StrOutputParser()).with_config(run_name="budgeted_qa_chain")
 
 
 def initialize_rag_system(session_manager: SessionManager):
@@ -19,7 +112,7 @@ def initialize_rag_system(session_manager: SessionManager):
     """
 
     llm = ChatOllama(model="qwen2.5:14b", temperature=0)
-    embeddings = OllamaEmbeddings(model="all-minilm:l6-v2")
+    embeddings = get_embeddings("all-minilm:l6-v2")
     persist_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../rag_chroma_data_dir'))
     if not os.path.exists(persist_dir):
         os.makedirs(persist_dir)
@@ -40,8 +133,12 @@ def initialize_rag_system(session_manager: SessionManager):
         MessagesPlaceholder("chat_history"),
         ("human", "{input}"),
     ])
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    # 稠密向量与 BM25 稀疏检索融合，较小的 k 也能保证召回
+    retriever = HybridRetriever(vectorstore=vectorstore, sparse_index=get_sparse_index(vectorstore),
+                                reranker=get_reranker(), k=RAG_TOP_K)
+    # 问题重写交给更小更快的模型，只在问题依赖历史时才调用
+    rewrite_chain = contextualize_q_prompt | ChatOllama(model=REWRITE_MODEL, temperature=0) | StrOutputParser()
+    history_aware_retriever = build_contextual_retriever(retriever, rewrite_chain, k=RAG_TOP_K)
     system_prompt = (
         "You are an assistant for question-answering tasks. You need to understand and combine the "
         "following context to answer questions before each answer. If you don't know the answer, say that you don't know. "
@@ -54,7 +151,7 @@ def initialize_rag_system(session_manager: SessionManager):
         MessagesPlaceholder("chat_history"),
         ("human", "{input}"),
     ])
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+    question_answer_chain = create_budgeted_qa_chain(llm, qa_prompt)
     rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
     return RunnableWithMessageHistory(
         rag_chain,
@@ -65,30 +162,131 @@ def initialize_rag_system(session_manager: SessionManager):
     ), vectorstore
 
 
-def add_document_by_url(url: str, vectorstore: Chroma, classname: str):
+# 入库流水线参数：每批向量化的文本块数量，以及同时进行向量化/写入的批次数
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 32))
+INGEST_CONCURRENCY = int(os.getenv('INGEST_CONCURRENCY', 4))
+
+
+def chunk_fingerprint(source: str, content: str) -> str:
+    """文本块指纹：来源与内容的哈希，作为向量库中的稳定 ID"""
+    return hashlib.sha256(f"{source}\x1f{content}".encode("utf-8")).hexdigest()
+
+
+async def ingest_documents(documents, vectorstore: Chroma, source: str, batch_size: int = INGEST_BATCH_SIZE,
+                           concurrency: int = INGEST_CONCURRENCY):
     """
-    通过给定 URL 和 CSS 类名加载网页内容，拆分后添加至向量库。
+    流式入库流水线：逐页加载 -> 拆分 -> 按批向量化并写入向量库。
+    同时在途的批次数受 concurrency 限制，加载会等待空闲槽位，因此内存占用与文档页数无关。
+    每个文本块以指纹作为 ID，已存在的块跳过向量化；入库结束后删除该来源下本次未出现的旧块，
+    因此重复提交是幂等的，重新提交修改过的文档只处理变化的部分。
+    本次没有解析出任何文本块时不删除旧块，只产出警告。
+    以异步生成器形式产出进度文本。
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=200)
+    embeddings = vectorstore.embeddings
+    sparse_index = get_sparse_index(vectorstore)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = {"pages": 0, "chunks": 0, "stored": 0, "skipped": 0, "deleted": 0}
+    tasks = set()
+    errors = []
+    existing = await asyncio.to_thread(vectorstore._collection.get, where={"source": source}, include=[])
+    existing_ids = set(existing["ids"])
+    seen_ids = set()
+
+    def status(prefix: str = "入库中") -> str:
+        return (f"{prefix}: 已加载 {progress['pages']} 页, 已入库 {progress['stored']}/{progress['chunks']} 个文本块, "
+                f"未变化跳过 {progress['skipped']} 个, 删除过期 {progress['deleted']} 个")
+
+    async def store(batch):
+        try:
+            vectors = await embeddings.aembed_documents([doc.page_content for doc in batch])
+            await asyncio.to_thread(
+                vectorstore._collection.upsert,
+                ids=[doc.id for doc in batch],
+                embeddings=vectors,
+                documents=[doc.page_content for doc in batch],
+                metadatas=[doc.metadata or None for doc in batch],
+            )
+            await asyncio.to_thread(sparse_index.add, [doc.id for doc in batch], [doc.page_content for doc in batch])
+            progress["stored"] += len(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            semaphore.release()
+
+    async def submit(batch):
+        await semaphore.acquire()
+        if errors:
+            semaphore.release()
+            raise errors[0]
+        task = asyncio.create_task(store(batch))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    batch = []
+    async for document in documents:
+        progress["pages"] += 1
+        for chunk in splitter.split_documents([document]):
+            chunk.metadata["source"] = source
+            chunk.id = chunk_fingerprint(source, chunk.page_content)
+            if chunk.id in seen_ids:
+                continue
+            seen_ids.add(chunk.id)
+            progress["chunks"] += 1
+            if chunk.id in existing_ids:
+                progress["skipped"] += 1
+                progress["stored"] += 1
+                continue
+            batch.append(chunk)
+        while len(batch) >= batch_size:
+            await submit(batch[:batch_size])
+            batch = batch[batch_size:]
+        yield status()
+    if batch:
+        await submit(batch)
+    while tasks:
+        await asyncio.gather(*tasks)
+        yield status()
+    if errors:
+        raise errors[0]
+    if not seen_ids:
+        # 本次没有解析出任何文本块(如 CSS 类名填错或页面暂时为空)，保留该来源已有内容而不是全部删除
+        if existing_ids:
+            logging.warning(f"{source} 未解析出任何文本块, 保留已有的 {len(existing_ids)} 个文本块")
+            yield status(f"警告: 未解析出任何文本块, 已保留该来源原有的 {len(existing_ids)} 个文本块, 请检查地址或类名")
+        else:
+            yield status("警告: 未解析出任何文本块, 请检查地址或类名")
+        return
+    stale_ids = list(existing_ids - seen_ids)
+    for start in range(0, len(stale_ids), batch_size):
+        await asyncio.to_thread(vectorstore._collection.delete, ids=stale_ids[start:start + batch_size])
+    if stale_ids:
+        await asyncio.to_thread(sparse_index.delete, stale_ids)
+    progress["deleted"] = len(stale_ids)
+    if progress["stored"] > progress["skipped"] or stale_ids:
+        # 集合内容发生变化，之前缓存的答案可能已过时
+        answer_cache.invalidate(vectorstore._collection.name)
+    yield status("入库完成")
+
+
+async def add_document_by_url(url: str, vectorstore: Chroma, classname: str):
+    """
+    通过给定 URL 和 CSS 类名加载网页内容，拆分后流式添加至向量库，产出进度文本。
     """
     from langchain_community.document_loaders import WebBaseLoader
     loader = WebBaseLoader(
         web_paths=[url],
         bs_kwargs=dict(parse_only=bs4.SoupStrainer(class_=classname)),
     )
-    new_docs = loader.load()
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=200)
-    new_splits = splitter.split_documents(new_docs)
-    vectorstore.add_documents(new_splits)
+    async for status in ingest_documents(loader.alazy_load(), vectorstore, url):
+        yield status
 
 
 async def add_document_by_pdf(pdf_path: str, vectorstore: Chroma):
     """
-    加载 PDF 文件内容，拆分后添加至向量库。
+    逐页加载 PDF 文件内容，拆分后流式添加至向量库，产出进度文本。
     """
     from langchain_community.document_loaders import PyPDFLoader
     loader = PyPDFLoader(pdf_path)
-    pages = []
-    async for page in loader.alazy_load():
-        pages.append(page)
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=200)
-    new_splits = splitter.split_documents(pages)
-    vectorstore.add_documents(new_splits)
+    async for status in ingest_documents(loader.alazy_load(), vectorstore, pdf_path):
+        yield status
@@ -1,15 +1,255 @@
-from langchain_community.chat_message_histories import ChatMessageHistory
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, message_to_dict, messages_from_dict
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_ollama import ChatOllama
+
+SESSION_DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../session_history.db'))
+# 保留在提示词中的最近对话轮数与估算 token 上限，超出部分压缩进摘要
+SESSION_MAX_TURNS = int(os.getenv('SESSION_MAX_TURNS', 6))
+SESSION_MAX_TOKENS = int(os.getenv('SESSION_MAX_TOKENS', 2000))
+SESSION_SUMMARY_CHARS = int(os.getenv('SESSION_SUMMARY_CHARS', 800))
+# 维护运行摘要的小模型(默认与问题重写共用)，为空时退化为截断旧对话
+SESSION_SUMMARY_MODEL = os.getenv('SESSION_SUMMARY_MODEL', os.getenv('RAG_REWRITE_MODEL', 'qwen2.5:1.5b'))
+# 内存中最多保留的会话数，超出后淘汰最久未使用的会话(数据仍保存在 SQLite 中)
+SESSION_MAX_IN_MEMORY = int(os.getenv('SESSION_MAX_IN_MEMORY', 256))
+# 空闲超过该秒数的会话从内存中回收；超过保留期的会话从 SQLite 中删除
+SESSION_IDLE_TIMEOUT = int(os.getenv('SESSION_IDLE_TIMEOUT', 30 * 60))
+SESSION_RETENTION = int(os.getenv('SESSION_RETENTION', 24 * 60 * 60))
+
+CJK_PATTERN = re.compile(r'[\u3000-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按一个 token，其余按四个字符一个 token"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_role(message: BaseMessage) -> str:
+    return "用户" if message.type == "human" else "助手"
+
+
+def truncate_summarizer(summary: str, messages: Sequence[BaseMessage]) -> str:
+    """截断方式的摘要：不调用模型，把被压缩的对话各截取开头追加到末尾，只保留最近的部分"""
+    lines = [summary] if summary else []
+    for message in messages:
+        lines.append(f"{message_role(message)}: {str(message.content)[:80]}")
+    return "\n".join(lines)[-SESSION_SUMMARY_CHARS:]
+
+
+class LLMSummarizer:
+    """
+    运行摘要：用小模型把已有摘要与被压缩的对话改写成一份新的摘要，
+    早期对话中的关键信息不会因截断而丢失。模型调用失败或返回为空时退回截断方式。
+    """
+
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "你负责维护一段对话的摘要。请把已有摘要和新增的对话合并成一份新的摘要，"
+                   "保留用户的目标、提到的人名/地名/数字等关键事实和已经得出的结论，省略寒暄与重复内容。"
+                   "只输出摘要正文，使用中文，不超过{max_chars}个字。"),
+        ("human", "已有摘要:\n{summary}\n\n新增对话:\n{dialogue}"),
+    ])
+
+    def __init__(self, model: str = SESSION_SUMMARY_MODEL, max_chars: int = SESSION_SUMMARY_CHARS):
+        self.max_chars = max_chars
+        self.chain = self.prompt | ChatOllama(model=model, temperature=0) | StrOutputParser()
+
+    def __call__(self, summary: str, messages: Sequence[BaseMessage]) -> str:
+        dialogue = "\n".join(f"{message_role(message)}: {message.content}" for message in messages)
+        try:
+            result = self.chain.invoke({"summary": summary or "(无)", "dialogue": dialogue,
+                                        "max_chars": self.max_chars}).strip()
+        except Exception as e:
+            logging.warning(f"生成会话摘要失败, 改用截断方式: {e}")
+            result = ""
+        if not result:
+            return truncate_summarizer(summary, messages)
+        return result[:self.max_chars]
+
+
+def default_summarizer() -> Callable:
+    """配置了摘要模型时使用模型生成运行摘要，否则截断旧对话"""
+    return LLMSummarizer() if SESSION_SUMMARY_MODEL else truncate_summarizer
+
+
+class SessionStore:
+    """会话历史的 SQLite 持久化存储"""
+
+    def __init__(self, db_path: str = SESSION_DB_PATH):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(
+                "PRAGMA journal_mode=WAL;"
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, summary TEXT NOT NULL DEFAULT '', last_active REAL);"
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message TEXT NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id);"
+            )
+            self._conn.commit()
+
+    def load(self, session_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            rows = self._conn.execute("SELECT id, message FROM messages WHERE session_id = ? ORDER BY id",
+                                      (session_id,)).fetchall()
+        messages = messages_from_dict([json.loads(message) for _, message in rows])
+        return (row[0] if row else ""), [message_id for message_id, _ in rows], messages
+
+    def append(self, session_id: str, messages: Sequence[BaseMessage]) -> List[int]:
+        with self._lock:
+            ids = []
+            for message in messages:
+                cursor = self._conn.execute(
+                    "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                    (session_id, json.dumps(message_to_dict(message), ensure_ascii=False)),
+                )
+                ids.append(cursor.lastrowid)
+            self._touch(session_id)
+            self._conn.commit()
+            return ids
+
+    def compact(self, session_id: str, summary: str, until_id: int):
+        """删除已压缩进摘要的消息并保存新的摘要"""
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ? AND id <= ?", (session_id, until_id))
+            self._touch(session_id)
+            self._conn.execute("UPDATE sessions SET summary = ? WHERE session_id = ?", (summary, session_id))
+            self._conn.commit()
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def purge(self, older_than: float) -> int:
+        """删除最后活跃时间早于 older_than 的会话，返回删除数量"""
+        with self._lock:
+            expired = "SELECT session_id FROM sessions WHERE last_active < ?"
+            self._conn.execute(f"DELETE FROM messages WHERE session_id IN ({expired})", (older_than,))
+            count = self._conn.execute("DELETE FROM sessions WHERE last_active < ?", (older_than,)).rowcount
+            self._conn.commit()
+            return count
+
+    def _touch(self, session_id: str):
+        self._conn.execute(
+            "INSERT INTO sessions (session_id, last_active) VALUES (?, ?) "
+            "ON CONFLICT(session_id) DO UPDATE SET last_active = excluded.last_active",
+            (session_id, time.time()),
+        )
+
+
+class BoundedChatHistory(BaseChatMessageHistory):
+    """
+    有界的会话历史：只保留最近若干轮对话，超出轮数或 token 上限的旧对话压缩进运行摘要，
+    提示词大小不随对话长度增长。
+    """
+
+    def __init__(self, session_id: str, store: SessionStore, max_turns: int = SESSION_MAX_TURNS,
+                 max_tokens: int = SESSION_MAX_TOKENS, summarizer: Callable = truncate_summarizer):
+        self.session_id = session_id
+        self.store = store
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self._lock = threading.Lock()
+        self.summary, self._ids, self._window = store.load(session_id)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        with self._lock:
+            prefix = [SystemMessage(content=f"之前对话的摘要:\n{self.summary}")] if self.summary else []
+            return prefix + list(self._window)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with self._lock:
+            self._ids.extend(self.store.append(self.session_id, messages))
+            self._window.extend(messages)
+            self._compact()
+
+    def _compact(self):
+        dropped = 0
+        # 按一问一答成对压缩，且至少保留最近一轮
+        while len(self._window) - dropped > 2 and self._over_budget_from(dropped):
+            dropped += 2
+        if not dropped:
+            return
+        self.summary = self.summarizer(self.summary, self._window[:dropped])
+        self.store.compact(self.session_id, self.summary, self._ids[dropped - 1])
+        self._window = self._window[dropped:]
+        self._ids = self._ids[dropped:]
+
+    def _over_budget_from(self, start: int) -> bool:
+        window = self._window[start:]
+        if len(window) > self.max_turns * 2:
+            return True
+        return sum(estimate_tokens(str(message.content)) for message in window) > self.max_tokens
+
+    def clear(self) -> None:
+        with self._lock:
+            self.store.clear(self.session_id)
+            self.summary, self._ids, self._window = "", [], []
 
 
 class SessionManager:
     """
-    管理共享的会话历史记录
+    管理共享的会话历史记录，历史持久化到 SQLite，内存中按 LRU 保留活跃会话
     """
 
-    def __init__(self):
-        self.store = {}
+    def __init__(self, db_path: str = SESSION_DB_PATH, max_sessions: int = SESSION_MAX_IN_MEMORY,
+                 max_turns: int = SESSION_MAX_TURNS, max_tokens: int = SESSION_MAX_TOKENS,
+                 summarizer: Optional[Callable] = None):
+        self.session_store = SessionStore(db_path)
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer or default_summarizer()
+        self.store = OrderedDict()
+        self._last_access = {}
+        self._lock = threading.Lock()
+
+    def get_session_history(self, session_id: str) -> BoundedChatHistory:
+        with self._lock:
+            self._last_access[session_id] = time.monotonic()
+            if session_id in self.store:
+                self.store.move_to_end(session_id)
+                return self.store[session_id]
+            history = BoundedChatHistory(session_id, self.session_store, self.max_turns,
+                                         self.max_tokens, self.summarizer)
+            self.store[session_id] = history
+            while len(self.store) > self.max_sessions:
+                evicted, _ = self.store.popitem(last=False)
+                self._last_access.pop(evicted, None)
+            return history
+
+    def release(self, session_id: str, forget: bool = False):
+        """释放会话占用的内存，forget 为 True 时同时删除持久化的历史"""
+        with self._lock:
+            self.store.pop(session_id, None)
+            self._last_access.pop(session_id, None)
+        if forget:
+            self.session_store.clear(session_id)
 
-    def get_session_history(self, session_id: str) -> ChatMessageHistory:
-        if session_id not in self.store:
-            self.store[session_id] = ChatMessageHistory()
-        return self.store[session_id]
+    def collect_idle(self, max_idle: float = SESSION_IDLE_TIMEOUT, retention: float = SESSION_RETENTION) -> int:
+        """回收空闲会话并清理超过保留期的持久化会话，返回从内存回收的数量"""
+        deadline = time.monotonic() - max_idle
+        with self._lock:
+            idle = [session_id for session_id, last in self._last_access.items() if last < deadline]
+            for session_id in idle:
+                self.store.pop(session_id, None)
+                self._last_access.pop(session_id, None)
+        self.session_store.purge(time.time() - retention)
+        return len(idle)
@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable
+
+# 后台预热组件时使用的线程数
+STARTUP_WORKERS = int(os.getenv('STARTUP_WORKERS', 4))
+
+PENDING, LOADING, READY, FAILED = "pending", "loading", "ready", "failed"
+STATE_LABELS = {PENDING: "等待加载", LOADING: "加载中", READY: "已就绪", FAILED: "加载失败"}
+
+
+class Component:
+    """一个可延迟加载的重型组件，记录加载状态、耗时与结果"""
+
+    def __init__(self, name: str, loader: Callable[[], Any], depends: Iterable[str] = ()):
+        self.name = name
+        self.loader = loader
+        self.depends = tuple(depends)
+        self.state = PENDING
+        self.value = None
+        self.error = None
+        self.seconds = None
+        self._ready = threading.Event()
+
+
+class StartupManager:
+    """
+    启动管理器：登记各个重型组件的加载函数，在后台线程中并行预热，
+    也可在首次使用时按需加载。界面无需等待全部组件即可启动，
+    每个组件就绪后对应功能即可使用，并记录各组件的加载耗时。
+    """
+
+    def __init__(self):
+        self._components: Dict[str, Component] = {}
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+
+    def register(self, name: str, loader: Callable[[], Any], depends: Iterable[str] = ()):
+        """登记组件，depends 中的组件会在加载该组件前先就绪"""
+        with self._lock:
+            self._components[name] = Component(name, loader, depends)
+
+    def _load(self, component: Component):
+        with self._lock:
+            if component.state != PENDING:
+                return
+            component.state = LOADING
+        start = time.perf_counter()
+        try:
+            for name in component.depends:
+                self.get(name)
+            component.value = component.loader()
+            component.state = READY
+            logging.info(f"组件 {component.name} 加载完成, 耗时 {time.perf_counter() - start:.3f}s")
+        except Exception as e:
+            component.error = e
+            component.state = FAILED
+            logging.exception(f"组件 {component.name} 加载失败")
+        finally:
+            component.seconds = time.perf_counter() - start
+            component._ready.set()
+
+    def start(self, names: Iterable[str] = None, max_workers: int = STARTUP_WORKERS):
+        """在后台线程中并行预热组件，立即返回"""
+        components = [self._components[name] for name in (names or list(self._components))]
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="startup")
+        for component in components:
+            executor.submit(self._load, component)
+        executor.shutdown(wait=False)
+        threading.Thread(target=self._report_when_done, args=(components,), name="startup-report",
+                         daemon=True).start()
+
+    def _report_when_done(self, components):
+        for component in components:
+            component._ready.wait()
+        logging.info("启动耗时统计:\n" + self.report())
+
+    def get(self, name: str, timeout: float = None) -> Any:
+        """返回组件实例，尚未加载时在当前线程加载，正在加载时等待其完成"""
+        component = self._components[name]
+        if component.state == PENDING:
+            self._load(component)
+        if not component._ready.wait(timeout):
+            raise TimeoutError(f"组件 {name} 在 {timeout}s 内未就绪")
+        if component.state == FAILED:
+            raise RuntimeError(f"组件 {name} 加载失败: {component.error}")
+        return component.value
+
+    def peek(self, name: str) -> Any:
+        """组件已就绪时返回实例，否则返回 None，不会触发加载"""
+        component = self._components[name]
+        return component.value if component.state == READY else None
+
+    def is_ready(self, name: str) -> bool:
+        return self._components[name].state == READY
+
+    def finished(self) -> bool:
+        """所有组件均已加载完成(成功或失败)"""
+        return all(component.state in (READY, FAILED) for component in self._components.values())
+
+    def status(self) -> Dict[str, dict]:
+        return {
+            name: {"state": component.state, "seconds": component.seconds,
+                   "error": str(component.error) if component.error else None}
+            for name, component in self._components.items()
+        }
+
+    def report(self) -> str:
+        """各组件的加载状态与耗时，供日志与界面展示"""
+        lines = []
+        for name, component in self._components.items():
+            seconds = f"{component.seconds:.2f}s" if component.seconds is not None else "-"
+            lines.append(f"{name}: {STATE_LABELS[component.state]} ({seconds})")
+        lines.append(f"进程启动至今: {time.perf_counter() - self._started_at:.2f}s")
+        return "\n".join(lines)
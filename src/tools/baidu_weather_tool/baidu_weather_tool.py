@@ -1,25 +1,122 @@
+import bisect
 import csv
 import os
+import re
+import threading
 from typing import Type, Optional
 
-import requests
 from langchain_core.callbacks import CallbackManagerForToolRun
 from langchain_core.tools import BaseTool
 from pydantic import BaseModel, Field
+from tools.baidu_weather_tool.weather_client import weather_client
+
+
+DISTRICT_CSV_PATH = os.path.join(os.path.dirname(__file__), 'weather_district_id.csv')
+# 行政区划名称后缀，匹配时去掉以兼容 "北京市" 与 "北京" 这类写法
+REGION_SUFFIX = re.compile(r'(特别行政区|自治区|自治州|自治县|地区|省|市|区|县|盟|旗)$')
+
+
+def normalize_region(name: str) -> str:
+    name = name.strip()
+    stripped = REGION_SUFFIX.sub('', name)
+    return stripped if len(stripped) >= 2 else name
+
+
+class DistrictIndex:
+    """
+    地区编码索引，只在首次查询时解析一次 CSV，之后常驻内存。
+    支持精确匹配、去后缀匹配、前缀匹配，以及按 省/市 前缀消歧和回退到城市/省份编码。
+    """
+
+    def __init__(self, csv_file_path: str):
+        self.exact = {}
+        self.districts = {}
+        self.regions = {}
+        with open(csv_file_path, mode='r', encoding='utf-8') as f:
+            csv_reader = csv.DictReader(f)
+            for row in csv_reader:
+                district_code = row['district_geocode'].strip()
+                district = row['district'].strip()
+                province = row['province'].strip()
+                city = row['city'].strip()
+                if district not in self.exact:
+                    self.exact[district] = district_code
+                self.districts.setdefault(normalize_region(district), []).append((district_code, province, city))
+                # 省份回退到该省第一个城市的编码，城市回退到城市编码；城市优先于同名省份
+                for name in (province, normalize_region(province)):
+                    self.regions.setdefault(name, (province, None, row['city_geocode'].strip()))
+                for name in (city, normalize_region(city)):
+                    if name not in self.regions or self.regions[name][1] is None:
+                        self.regions[name] = (province, city, row['city_geocode'].strip())
+        self.sorted_names = sorted(self.districts)
+
+    def _strip_scope(self, name: str):
+        """剥离开头的省/市名称，返回 (剩余名称, 范围)；剩余部分本身是区县名时停止剥离"""
+        scope = None
+        while name and normalize_region(name) not in self.districts:
+            for length in range(len(name), 1, -1):
+                region = self.regions.get(name[:length])
+                # 后续剥离的城市必须位于已确定的省份之内
+                if region and (scope is None or region[0] == scope[0]):
+                    if scope is None or region[1] is not None:
+                        scope = region
+                    name = name[length:]
+                    break
+            else:
+                break
+        return name, scope
+
+    @staticmethod
+    def _pick(candidates, scope):
+        if scope:
+            province, city, _ = scope
+            for code, candidate_province, candidate_city in candidates:
+                if candidate_province == province and (city is None or candidate_city == city):
+                    return code
+        return candidates[0][0] if candidates else None
+
+    def _prefix_candidates(self, key: str, limit: int = 20) -> list:
+        start = bisect.bisect_left(self.sorted_names, key)
+        candidates = []
+        for name in self.sorted_names[start:start + limit]:
+            if not name.startswith(key):
+                break
+            candidates.extend(self.districts[name])
+        return candidates
+
+    def lookup(self, district_name: str):
+        if not district_name:
+            return None
+        district_name = district_name.strip()
+        if district_name in self.exact:
+            return self.exact[district_name]
+        # 带后缀的完整城市/省份名称，如 "朝阳市"
+        if district_name in self.regions and normalize_region(district_name) != district_name:
+            return self.regions[district_name][2]
+        rest, scope = self._strip_scope(district_name)
+        if rest:
+            key = normalize_region(rest)
+            code = (self._pick(self.districts.get(key, []), scope)
+                    or self._pick(self._prefix_candidates(key), scope))
+            if code:
+                return code
+        return scope[2] if scope else None
+
+
+_district_indexes = {}
+_district_lock = threading.Lock()
+
+
+def get_district_index(csv_file_path: str = DISTRICT_CSV_PATH) -> DistrictIndex:
+    """懒加载并缓存地区编码索引"""
+    with _district_lock:
+        if csv_file_path not in _district_indexes:
+            _district_indexes[csv_file_path] = DistrictIndex(csv_file_path)
+        return _district_indexes[csv_file_path]
 
 
 def find_code(csv_file_path, district_name) -> str:
-    district_map = {}
-
-    with open(csv_file_path, mode='r', encoding='utf-8') as f:
-        csv_reader = csv.DictReader(f)
-        for row in csv_reader:
-            district_code = row['district_geocode'].strip()
-            district = row['district'].strip()
-            if district not in district_map:
-                district_map[district] = district_code
-
-        return district_map.get(district_name)
+    return get_district_index(csv_file_path).lookup(district_name)
 
 
 def get_ak():
@@ -44,24 +141,20 @@ class WeatherTool(BaseTool):
     ) -> str:
         """调用工具自动执行的函数"""
 
-        district_code = find_code(os.path.join(os.path.dirname(__file__),
-                                               'weather_district_id.csv'),
-                                  location)
+        district_code = find_code(DISTRICT_CSV_PATH, location)
         ak = get_ak()
 
         print(f'需要查询的{location}的地区编码是: {district_code}')
-        url = "https://api.map.baidu.com/weather/v1/"
-
-        params = {
-            "district_id": district_code,
-            "data_type": "all",
-            "ak": ak,
-        }
-
-        weather_resp = requests.get(url, params)
-        if weather_resp:
-            data = weather_resp.json()
-
+        if not district_code:
+            return "当前暂时无法获取天气"
+
+        try:
+            data = weather_client.get_weather(district_code, ak)
+        except Exception as e:
+            print(f"天气查询失败: {str(e)}")
+            return "当前暂时无法获取天气"
+        print(f"天气缓存统计: {weather_client.stats()}")
+        if data:
             code = data['status']
             if code == 0:
                 text = data["result"]["now"]['text']
@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+
+from urllib3.util.retry import Retry
+
+from tools.http_session import create_session, REQUEST_TIMEOUT
+
+WEATHER_API_URL = os.getenv('BAIDU_WEATHER_URL', "https://api.map.baidu.com/weather/v1/")
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', 600))
+
+
+class _InFlight:
+    """同一地区正在进行中的请求，并发调用方等待并共享其结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WeatherClient:
+    """
+    百度天气接口客户端：复用连接池会话，带超时和指数退避重试，
+    按地区编码做 TTL 缓存，并把同一地区的并发查询合并为一次请求。
+    """
+
+    def __init__(self, url: str = WEATHER_API_URL, ttl: int = WEATHER_CACHE_TTL, retries: int = 3):
+        self.url = url
+        self.ttl = ttl
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("GET",))
+        self.session = create_session(max_retries=retry)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def _fetch(self, district_id: str, ak: str) -> dict:
+        params = {
+            "district_id": district_id,
+            "data_type": "all",
+            "ak": ak,
+        }
+        weather_resp = self.session.get(self.url, params=params, timeout=REQUEST_TIMEOUT)
+        weather_resp.raise_for_status()
+        return weather_resp.json()
+
+    def get_weather(self, district_id: str, ak: str) -> dict:
+        """查询地区天气，返回接口原始 JSON；只缓存 status 为 0 的成功结果"""
+        with self._lock:
+            cached = self._cache.get(district_id)
+            if cached and cached[0] > time.monotonic():
+                self.hits += 1
+                return cached[1]
+            in_flight = self._in_flight.get(district_id)
+            owner = in_flight is None
+            if owner:
+                self.misses += 1
+                in_flight = self._in_flight[district_id] = _InFlight()
+            else:
+                self.coalesced += 1
+        if not owner:
+            in_flight.event.wait()
+            if in_flight.error:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            data = self._fetch(district_id, ak)
+            in_flight.result = data
+            if data.get('status') == 0:
+                with self._lock:
+                    self._cache[district_id] = (time.monotonic() + self.ttl, data)
+            return data
+        except Exception as e:
+            in_flight.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(district_id, None)
+            in_flight.event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                "cached_districts": len(self._cache),
+            }
+
+
+weather_client = WeatherClient()
@@ -1,44 +1,23 @@
-import os
-import smtplib
-
 from typing import Type, Optional
 from apscheduler.triggers.date import DateTrigger
 from pydantic import BaseModel, Field
-from email.mime.text import MIMEText
-from email.utils import formataddr
 from langchain_core.callbacks import CallbackManagerForToolRun
 from langchain_core.tools import BaseTool
 from datetime import datetime
 from tools.email_tool.scheduler import Scheduler
+from tools.email_tool.mailer import get_mailer, OutgoingMail
 
-EMAIL_CONFIG = {
-    'smtp_server': os.getenv('SMTP_SERVER'),
-    'smtp_port': os.getenv('SMTP_PORT'),
-    'sender_email': os.getenv('SENDER_EMAIL'),
-    'sender_password': os.getenv('SENDER_PASSWORD'),
-    'sender_name': os.getenv('SENDER_NAME'),
-}
-
-scheduler = Scheduler()
-scheduler.start()
 
+def get_scheduler() -> Scheduler:
+    """获取定时任务调度器，首次使用时才启动后台线程"""
+    scheduler = Scheduler()
+    scheduler.start()
+    return scheduler
 
-def send_email(subject, content):
-    """发送邮件函数"""
-    msg = MIMEText(content, 'plain', 'utf-8')
-    msg['From'] = formataddr((EMAIL_CONFIG['sender_name'], EMAIL_CONFIG['sender_email']))
-    msg['To'] = EMAIL_CONFIG['receiver_email']
-    msg['Subject'] = subject
 
-    try:
-        with smtplib.SMTP_SSL(EMAIL_CONFIG['smtp_server'], int(EMAIL_CONFIG['smtp_port'])) as server:
-            server.login(EMAIL_CONFIG['sender_email'], EMAIL_CONFIG['sender_password'])
-            server.sendmail(EMAIL_CONFIG['sender_email'],
-                            [EMAIL_CONFIG['receiver_email']],
-                            msg.as_string())
-            print("邮件发送成功")
-    except Exception as e:
-        print(f"邮件发送失败: {str(e)}")
+def send_email(receiver_email, subject, content):
+    """把邮件提交到后台发送队列，立即返回"""
+    get_mailer().submit(OutgoingMail(receiver_email, subject, content))
 
 
 class EmailInputArgs(BaseModel):
@@ -101,19 +80,18 @@ class EmailTool(BaseTool):
 
         if all(v is not None for v in variables):
             try:
-                EMAIL_CONFIG['receiver_email'] = receiver_email
                 target_time = datetime(year, month, day, hour, minute, second)
-                scheduler.add_job(
+                job_id = get_scheduler().add_job(
                     send_email,
                     trigger=DateTrigger(run_date=target_time),
-                    args=[subject, content]
+                    args=[receiver_email, subject, content]
                 )
-                return f"任务已经提交, 邮件发送时间为: {target_time.strftime('%Y-%m-%d %H:%M:%S')}"
+                return (f"任务已经提交, 任务编号为: {job_id}, "
+                        f"邮件发送时间为: {target_time.strftime('%Y-%m-%d %H:%M:%S')}")
             except Exception as e:
                 return f"定时任务创建失败: {str(e)}"
         elif all(v is None for v in variables):
-            EMAIL_CONFIG['receiver_email'] = receiver_email
-            send_email(subject, content)
-            return f"邮件发送成功, 发送时间为: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            send_email(receiver_email, subject, content)
+            return f"邮件已提交发送, 提交时间为: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         else:
             return "年月日时分秒参数有误，请重新确认并填写"
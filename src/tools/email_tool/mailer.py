@@ -0,0 +1,190 @@
+import os
+import time
+import queue
+import smtplib
+import logging
+import threading
+from email.mime.text import MIMEText
+from email.utils import formataddr
+
+# 一批最多合并发送的邮件数量
+MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 50))
+# 单封邮件最多尝试发送的次数(连接断开或临时错误时重连/重试)
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', 3))
+# 空闲连接超过该秒数后，复用前先用 NOOP 检查连接是否仍然可用
+SMTP_IDLE_CHECK = 30
+
+
+def load_email_config() -> dict:
+    """在首次发送时读取邮件配置，保证 config.env 已经加载"""
+    return {
+        'smtp_server': os.getenv('SMTP_SERVER'),
+        'smtp_port': int(os.getenv('SMTP_PORT', 465)),
+        'smtp_ssl': os.getenv('SMTP_SSL', 'true').lower() == 'true',
+        'sender_email': os.getenv('SENDER_EMAIL'),
+        'sender_password': os.getenv('SENDER_PASSWORD'),
+        'sender_name': os.getenv('SENDER_NAME'),
+    }
+
+
+class OutgoingMail:
+    """一封待发送的邮件，收件人随邮件保存，不依赖共享的全局配置"""
+
+    def __init__(self, receiver_email: str, subject: str, content: str):
+        self.receiver_email = receiver_email
+        self.subject = subject
+        self.content = content
+
+    def to_mime(self, sender_name: str, sender_email: str) -> MIMEText:
+        msg = MIMEText(self.content, 'plain', 'utf-8')
+        msg['From'] = formataddr((sender_name, sender_email))
+        msg['To'] = self.receiver_email
+        msg['Subject'] = self.subject
+        return msg
+
+
+class SMTPConnectionPool:
+    """
+    持久化的 SMTP 连接池，复用已登录的连接，断线时自动重新连接。
+    """
+
+    def __init__(self, config: dict, size: int = 2):
+        self.config = config
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.config['smtp_ssl']:
+            server = smtplib.SMTP_SSL(self.config['smtp_server'], self.config['smtp_port'], timeout=30)
+        else:
+            server = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'], timeout=30)
+        if self.config['sender_password']:
+            server.login(self.config['sender_email'], self.config['sender_password'])
+        return server
+
+    def acquire(self) -> smtplib.SMTP:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, released_at = self._idle.pop()
+            if time.monotonic() - released_at < SMTP_IDLE_CHECK:
+                return server
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.discard(server)
+        return self._connect()
+
+    def release(self, server: smtplib.SMTP):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((server, time.monotonic()))
+                return
+        self.discard(server)
+
+    @staticmethod
+    def discard(server: smtplib.SMTP):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self.discard(server)
+
+
+class Mailer:
+    """
+    异步邮件发送队列：调用方提交后立即返回，后台线程把同一时刻积压的邮件
+    合并为一批，经同一个连接发送。
+    """
+
+    def __init__(self, config: dict = None):
+        self.config = config or load_email_config()
+        self.pool = SMTPConnectionPool(self.config)
+        self._queue = queue.Queue()
+        # 发送成功与最终失败的邮件数量
+        self.sent = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._run, name="mailer", daemon=True)
+        self._worker.start()
+
+    def submit(self, mail: OutgoingMail):
+        self._queue.put(mail)
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        while len(batch) < MAIL_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send_batch(self, batch: list):
+        """逐封发送一批邮件，单封失败只影响这一封，不会中断后续邮件的发送"""
+        server = None
+        try:
+            for mail in batch:
+                msg = mail.to_mime(self.config['sender_name'], self.config['sender_email']).as_string()
+                for attempt in range(1, MAIL_MAX_ATTEMPTS + 1):
+                    try:
+                        if server is None:
+                            server = self.pool.acquire()
+                        server.sendmail(self.config['sender_email'], [mail.receiver_email], msg)
+                        self.sent += 1
+                        print(f"邮件发送成功: {mail.receiver_email}")
+                        break
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                        # 服务器明确拒收(如 554 判定为垃圾邮件)时重试无益，4xx 临时错误才重试
+                        permanent = getattr(e, 'smtp_code', 550) >= 500
+                        if permanent or attempt == MAIL_MAX_ATTEMPTS:
+                            self._fail(mail, e)
+                            break
+                    except (smtplib.SMTPException, OSError) as e:
+                        # 连接断开或其他错误：丢弃当前连接，下次尝试时重新连接
+                        if server is not None:
+                            self.pool.discard(server)
+                            server = None
+                        if attempt == MAIL_MAX_ATTEMPTS:
+                            self._fail(mail, e)
+        finally:
+            if server is not None:
+                self.pool.release(server)
+
+    def _fail(self, mail: OutgoingMail, error: Exception):
+        self.failed += 1
+        logging.error(f"邮件发送失败: {mail.receiver_email} {error!r}, 累计失败 {self.failed} 封")
+        print(f"邮件发送失败: {mail.receiver_email} {str(error)}")
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                logging.exception("邮件批量发送失败")
+                print(f"邮件发送失败: {str(e)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer() -> Mailer:
+    """懒加载进程内共享的邮件发送队列"""
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            _mailer = Mailer()
+        return _mailer
@@ -1,7 +1,18 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.base import JobLookupError
+from sqlalchemy import select
+import os
+import pickle
 import threading
 import atexit
 
+# 定时任务持久化到 SQLite，重启后仍然保留，按下次运行时间的索引查询到期任务
+JOB_STORE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../email_jobs.sqlite'))
+JOB_STORE_URL = os.getenv('EMAIL_JOB_STORE_URL', f"sqlite:///{JOB_STORE_PATH}")
+# 错过执行时间(如进程重启期间到期)的任务，在该秒数内仍会补发
+MISFIRE_GRACE_TIME = int(os.getenv('EMAIL_MISFIRE_GRACE_TIME', 60))
+
 
 class Scheduler:
     _instance = None
@@ -15,21 +26,53 @@ class Scheduler:
             return cls._instance
 
     def _init_scheduler(self):
+        self.job_store = SQLAlchemyJobStore(url=JOB_STORE_URL)
         self.scheduler = BackgroundScheduler(
             daemon=True,
+            jobstores={'default': self.job_store},
+            job_defaults={'coalesce': True, 'misfire_grace_time': MISFIRE_GRACE_TIME},
         )
         self._job_lock = threading.RLock()
         atexit.register(self.shutdown)
         print("后台调度器初始化完成")
 
-    def add_job(self, func, trigger, args):
+    def add_job(self, func, trigger, args) -> str:
         with self._job_lock:
-            self.scheduler.add_job(
+            job = self.scheduler.add_job(
                 func,
                 trigger,
-                misfire_grace_time=60,
+                misfire_grace_time=MISFIRE_GRACE_TIME,
                 args=args
             )
+            return job.id
+
+    def list_jobs(self, limit: int = 100) -> list:
+        """
+        按下次运行时间列出最近的 limit 个待执行任务。
+        直接按索引列 next_run_time 分页查询任务表，只反序列化返回的任务，
+        任务数量很大时内存占用与 limit 而不是任务总数相关。
+        """
+        jobs_t = self.job_store.jobs_t
+        query = (select(jobs_t.c.id, jobs_t.c.job_state)
+                 .where(jobs_t.c.next_run_time.isnot(None))
+                 .order_by(jobs_t.c.next_run_time)
+                 .limit(limit))
+        with self.job_store.engine.connect() as conn:
+            rows = conn.execute(query).all()
+        jobs = []
+        for job_id, job_state in rows:
+            state = pickle.loads(job_state)
+            jobs.append({"id": job_id, "next_run_time": state['next_run_time'], "args": list(state['args'])})
+        return jobs
+
+    def cancel_job(self, job_id: str) -> bool:
+        """取消待执行的任务，任务不存在时返回 False"""
+        with self._job_lock:
+            try:
+                self.scheduler.remove_job(job_id)
+                return True
+            except JobLookupError:
+                return False
 
     def start(self):
         with self._job_lock:
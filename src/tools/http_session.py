@@ -0,0 +1,31 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 各工具访问外部接口统一使用的 (连接超时, 读取超时)，单位秒
+REQUEST_TIMEOUT = (3.05, 10)
+# 每个会话缓存的主机连接池数与单个主机的最大 keep-alive 连接数
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(max_retries=0) -> requests.Session:
+    """创建挂载了 keep-alive 连接池的会话，max_retries 可传入重试次数或 urllib3 的 Retry 策略"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """获取进程内共享的不重试连接池会话"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
@@ -1,13 +1,13 @@
 import os
-from typing import Type, Optional
+from typing import Type, Optional, Literal, Tuple
 
 import numpy as np
-import requests
-from bs4 import BeautifulSoup
 from langchain_core.callbacks import CallbackManagerForToolRun
+from langchain_core.embeddings import Embeddings
 from langchain_core.tools import BaseTool
-from langchain_ollama import OllamaEmbeddings
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+from embedding_service import get_embeddings
+from tools.music_tool.http_client import find_video_cards_by_urls
 
 
 class AnalysisMusicUrlInputArgs(BaseModel):
@@ -19,12 +19,13 @@ class AnalysisMusicUrlInputArgs(BaseModel):
     )
 
 
-def find_video_card_by_url(headers, search_url):
-    response = requests.get(search_url, headers=headers)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    # 找到所有表示视频卡片的容器
-    video_cards = soup.find_all("div", class_="bili-video-card__info--right")
-    return video_cards
+def rank_by_similarity(query_vector, title_vectors) -> np.ndarray:
+    """对归一化后的标题向量矩阵做一次矩阵-向量乘法，得到每个标题与查询的余弦相似度"""
+    matrix = np.asarray(title_vectors, dtype=np.float32)
+    query = np.asarray(query_vector, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    return matrix @ query
 
 
 class AnalysisMusicUrlTool(BaseTool):
@@ -32,13 +33,16 @@ class AnalysisMusicUrlTool(BaseTool):
     description: str = """爬取网站获取歌曲备选URL列表。传入音乐名称和歌手名称(可选)
                     返回结果后选择其中最相关的一个视频标题, 使用它的url必须调用 download_music_tool 进行下载"""
     args_schema: Type[BaseModel] = AnalysisMusicUrlInputArgs
+    # 工具消息的 artifact 中附带按相似度排序的候选列表，供音乐代理快速通道使用
+    response_format: Literal["content", "content_and_artifact"] = "content_and_artifact"
+    _embeddings: Embeddings = PrivateAttr(default_factory=lambda: get_embeddings("all-minilm:l6-v2"))
 
     def _run(
             self,
             song_name: str,
             artist: Optional[str] = None,
             run_manager: Optional[CallbackManagerForToolRun] = None,
-    ) -> str:
+    ) -> Tuple[str, list]:
 
         if not song_name:
             raise ValueError("song_name为必填字段")
@@ -48,26 +52,16 @@ class AnalysisMusicUrlTool(BaseTool):
             "User-Agent": os.getenv("USER_AGENT")
         }
 
-        def cosine_similarity(vec1, vec2):
-            dot_product = np.dot(vec1, vec2)
-            norm1 = np.linalg.norm(vec1)
-            norm2 = np.linalg.norm(vec2)
-            return dot_product / (norm1 * norm2)
-
-        embeddings = OllamaEmbeddings(model="all-minilm:l6-v2")
         if artist:
             click_search_url = f"https://search.bilibili.com/all?keyword={artist} {song_name}&order=click"
-            vector1 = embeddings.embed_documents([f"{song_name}{artist}官方Hi-ResMV"])[0]
+            query = f"{song_name}{artist}官方Hi-ResMV"
         else:
             click_search_url = f"https://search.bilibili.com/all?keyword={song_name}&order=click"
-            vector1 = embeddings.embed_documents([f"{song_name}官方Hi-ResMV"])[0]
-        click_video_cards = find_video_card_by_url(headers, click_search_url)
-
+            query = f"{song_name}官方Hi-ResMV"
         search_url = click_search_url.split('&order=click')[0]
-        video_cards = find_video_card_by_url(headers, search_url)
-
-        sum_video_cards = list(click_video_cards) + list(video_cards)
-        results_dict = dict()
+        # 两个搜索页通过连接池并发请求
+        sum_video_cards = find_video_cards_by_urls(headers, [click_search_url, search_url])
+        candidates = dict()
         # 遍历每一个卡片，提取视频链接和标题
         for card in sum_video_cards:
             # 查找 a 标签，确保它包含 href 属性
@@ -84,33 +78,36 @@ class AnalysisMusicUrlTool(BaseTool):
                 title = title_tag.get_text(strip=False)
             else:
                 title = "标题未找到"
+            candidates[video_url] = title
 
-            vector2 = embeddings.embed_documents([title])[0]
+        if not candidates:
+            return "没有找到任何链接", []
 
-            similarity = cosine_similarity(vector1, vector2)
+        # 标题去重后与查询一起批量向量化，只请求一次
+        titles = list(dict.fromkeys(candidates.values()))
+        vectors = self._embeddings.embed_documents([query] + titles)
+        title_scores = dict(zip(titles, rank_by_similarity(vectors[0], vectors[1:])))
 
-            results_dict[video_url] = {
+        result_list = [
+            {
                 "title": title,
                 "url": f"https:{video_url}",
-                "similarity": float(similarity)
+                "similarity": float(title_scores[title])
             }
-
-        result_list = list(results_dict.values())
-        if result_list:
-            # 按相似度降序排序
-            sorted_results = sorted(result_list, key=lambda x: x["similarity"], reverse=True)
-
-            sorted_results = sorted_results[:15]
-
-            # 格式化成字符串
-            formatted_results = [
-                f"标题: {item['title']} | URL: {item['url']} | 相似度得分: {item['similarity']:.4f}"
-                for item in sorted_results
-            ]
-
-            return (
-                    "找到以下备选下载链接: \n" + '\n'.join(formatted_results) +
-                    "\n必须且只能从以上选择里选择一个你认为最有可能是匹配歌曲文件的选项, 只返回对应的URL"
-            )
-        else:
-            return "没有找到任何链接"
+            for video_url, title in candidates.items()
+        ]
+        # 按相似度降序排序
+        sorted_results = sorted(result_list, key=lambda x: x["similarity"], reverse=True)
+
+        sorted_results = sorted_results[:15]
+
+        # 格式化成字符串
+        formatted_results = [
+            f"标题: {item['title']} | URL: {item['url']} | 相似度得分: {item['similarity']:.4f}"
+            for item in sorted_results
+        ]
+
+        return (
+                "找到以下备选下载链接: \n" + '\n'.join(formatted_results) +
+                "\n必须且只能从以上选择里选择一个你认为最有可能是匹配歌曲文件的选项, 只返回对应的URL"
+        ), sorted_results
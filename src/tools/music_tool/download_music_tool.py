@@ -1,9 +1,14 @@
+import os
+import queue
 from typing import Type, Optional
 import yt_dlp
 
 from langchain_core.callbacks import CallbackManagerForToolRun
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import BaseTool
 from pydantic import BaseModel, Field
+from tools.music_tool.music_library import music_library, MUSIC_DIR
+from tools.music_tool.download_queue import download_queue, DownloadJob
 
 
 class DownloadMusicInputArgs(BaseModel):
@@ -14,38 +19,76 @@ class DownloadMusicTool(BaseTool):
     name: str = "download_music_tool"
     description: str = "通过 analysis_music_url_tool 获取URL后，使用此工具进行实际下载"
     args_schema: Type[DownloadMusicInputArgs] = DownloadMusicInputArgs
+    # 允许下载的最大时长(秒)
+    max_duration: int = 600
+    # 是否统一转码为 mp3；关闭后若原始音频容器可接受则直接保留，省去重新编码的开销
+    transcode: bool = os.getenv('MUSIC_TRANSCODE', 'true').lower() == 'true'
+    native_audio_exts: tuple = ("m4a", "mp3", "aac", "ogg", "opus")
+    outtmpl: str = os.path.join(MUSIC_DIR, '%(title)s.%(ext)s')
 
     def _run(
             self,
             url: str,
+            config: RunnableConfig,
             run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
 
         if not url:
             raise ValueError("url必须为非空字符串")
 
+        # 音乐库中已有该视频时直接返回本地文件
+        entry = music_library.find_by_url(url)
+        if entry:
+            return "所有音乐下载成功。" + "音乐文件保存本地路径:" + entry['path']
+
+        # 实际下载交给后台下载队列，按会话归属任务以便查询进度和取消
+        owner = config.get('configurable', {}).get('thread_id')
+        try:
+            job = download_queue.submit(owner, url, lambda job: self._download(url, job))
+        except queue.Full:
+            return "下载失败:下载队列已满，请稍后再试"
+        return job.wait()
+
+    def _download(self, url: str, job: DownloadJob) -> str:
+        """探测并下载音乐，在下载队列的工作线程中执行"""
         ydl_opts = {
             'format': 'bestaudio/best',
             'quiet': True,
             'no_warnings': True,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '256',
-            }],
-            'outtmpl': '%(title)s.%(ext)s',
+            'outtmpl': self.outtmpl,
+            'progress_hooks': [job.progress_hook],
         }
 
         try:
+            # 第一阶段：只探测元数据，超长或已下载的视频不再下载
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+                if (info.get('duration') or 0) > self.max_duration:
+                    return f"下载失败:视频时长为{info.get('duration_string')},时长过长"
+                keep_native = not self.transcode and info.get('ext') in self.native_audio_exts
+                final_ext = info['ext'] if keep_native else 'mp3'
+                filepath = os.path.splitext(ydl.prepare_filename(info))[0] + '.' + final_ext
+            if os.path.exists(filepath):
+                music_library.add(url, info.get('title'), filepath, info.get('duration'))
+                return "所有音乐下载成功。" + "音乐文件保存本地路径:" + filepath
+
+            if job.cancelled:
+                return "下载失败:下载已取消"
+
+            # 第二阶段：复用探测结果进行实际下载，必要时转码
+            if not keep_native:
+                ydl_opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'mp3',
+                    'preferredquality': '256',
+                }]
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                if info['duration'] <= 600:
-                    if 'requested_downloads' in info:
-                        filepath = info['requested_downloads'][0]['filepath']
-                    else:
-                        filepath = ydl.prepare_filename(info)
-                else:
-                    return f"下载失败:视频时长为{info['duration_string']},时长过长"
+                info = ydl.process_ie_result(info, download=True)
+                if 'requested_downloads' in info:
+                    filepath = info['requested_downloads'][0]['filepath']
+            music_library.add(url, info.get('title'), filepath, info.get('duration'))
+        except yt_dlp.utils.DownloadCancelled:
+            return "下载失败:下载已取消"
         except Exception as e:
             return f"下载失败:{str(e)}"
 
@@ -0,0 +1,133 @@
+import os
+import queue
+import uuid
+import logging
+import threading
+
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 4))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv('DOWNLOAD_QUEUE_SIZE', 16))
+
+
+class DownloadJob:
+    """
+    单个下载任务，记录状态与进度，可以被取消；进度由 yt-dlp 的 progress_hooks 更新。
+    """
+
+    def __init__(self, owner: str, url: str, func):
+        self.id = uuid.uuid4().hex[:8]
+        self.owner = owner
+        self.url = url
+        self.func = func
+        self.status = "排队中"
+        self.progress = 0.0
+        self.result = None
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def finish(self, result: str):
+        self.result = result
+        self.status = "已完成"
+        self._done.set()
+
+    def wait(self, timeout: float = None) -> str:
+        self._done.wait(timeout)
+        return self.result
+
+    def progress_hook(self, d: dict):
+        """yt-dlp 进度回调，取消时抛出 DownloadCancelled 中断下载"""
+        if self.cancelled:
+            import yt_dlp
+            raise yt_dlp.utils.DownloadCancelled("下载已取消")
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                self.progress = d.get('downloaded_bytes', 0) / total
+            self.status = "下载中"
+        elif d['status'] == 'finished':
+            self.progress = 1.0
+            self.status = "转码中"
+
+    def describe(self) -> str:
+        if self.status == "下载中":
+            return f"{self.status} {self.progress:.0%}"
+        return self.status
+
+
+class DownloadQueue:
+    """
+    有界的后台下载队列，固定数量的工作线程并行执行下载任务，
+    调用方按会话查询任务进度或取消任务。
+    """
+
+    def __init__(self, workers: int = DOWNLOAD_WORKERS, max_pending: int = DOWNLOAD_QUEUE_SIZE):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _start_workers(self):
+        """首次提交任务时才启动工作线程，导入模块不产生后台线程"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f"music-download-{index}", daemon=True).start()
+
+    def submit(self, owner: str, url: str, func) -> DownloadJob:
+        """提交下载任务，func 接收任务对象并返回结果文本；队列已满时抛出 queue.Full"""
+        self._start_workers()
+        job = DownloadJob(owner, url, func)
+        # 先登记再入队，工作线程取到任务时一定能在 _jobs 中找到它；入队失败时撤销登记
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise
+        return job
+
+    def jobs_for(self, owner: str) -> list:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner]
+
+    def cancel(self, owner: str) -> int:
+        """取消某个会话的全部未完成任务，返回取消数量"""
+        jobs = self.jobs_for(owner)
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job.cancelled:
+                    job.finish("下载失败:下载已取消")
+                else:
+                    job.status = "下载中"
+                    job.finish(job.func(job))
+            except Exception as e:
+                logging.exception(f"下载任务 {job.id} 出错")
+                job.finish(f"下载失败:{str(e)}")
+            finally:
+                with self._lock:
+                    self._jobs.pop(job.id, None)
+                self._queue.task_done()
+
+
+download_queue = DownloadQueue()
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from tools.http_session import get_session, REQUEST_TIMEOUT
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# 只解析视频卡片容器，跳过页面其余部分
+VIDEO_CARD_STRAINER = SoupStrainer("div", class_="bili-video-card__info--right")
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="music-http")
+
+
+def find_video_card_by_url(headers, search_url):
+    response = get_session().get(search_url, headers=headers, timeout=REQUEST_TIMEOUT)
+    soup = BeautifulSoup(response.text, HTML_PARSER, parse_only=VIDEO_CARD_STRAINER)
+    # 找到所有表示视频卡片的容器
+    video_cards = soup.find_all("div", class_="bili-video-card__info--right")
+    return video_cards
+
+
+def find_video_cards_by_urls(headers, search_urls) -> list:
+    """并发请求多个搜索页，按传入顺序合并返回全部视频卡片"""
+    futures = [_executor.submit(find_video_card_by_url, headers, url) for url in search_urls]
+    video_cards = []
+    for future in futures:
+        video_cards.extend(future.result())
+    return video_cards
@@ -0,0 +1,154 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+# 音乐文件目录使用相对启动目录的路径，保证 Gradio allowed_paths=["."] 可以访问
+MUSIC_DIR = os.getenv('MUSIC_DIR', 'music')
+MUSIC_LIBRARY_MAX_BYTES = int(os.getenv('MUSIC_LIBRARY_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+VIDEO_ID_PATTERN = re.compile(r'BV[0-9A-Za-z]{10}')
+# 按请求文本直接命中时歌名的最短长度，过短的歌名(如"爱")容易误命中
+MIN_SONG_CHARS = int(os.getenv('MUSIC_LIBRARY_MIN_SONG_CHARS', 2))
+# 请求中去掉歌名、歌手后允许剩下的客套/动作用词，剩下其他内容(另一位歌手、第二首歌、否定等)时不直接命中
+FILLER_PATTERN = re.compile(r'帮我|帮忙|麻烦|请|给我|我想|我要|想要|下载|播放|来一首|一首|一下|这首歌|这首|歌曲|音乐|的歌|吧|呀|啊|的|听|首|歌')
+
+
+def normalize_title(text: str) -> str:
+    """归一化标题/歌名：全半角统一、转小写，并去掉空白与标点"""
+    return re.sub(r'[\W_]+', '', unicodedata.normalize("NFKC", text or "").lower())
+
+
+def extract_video_id(url: str) -> str:
+    """从视频链接中提取 BV 号，提取不到时使用归一化后的链接本身"""
+    match = VIDEO_ID_PATTERN.search(url)
+    return match.group(0) if match else url.split('?')[0].rstrip('/')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MusicLibrary:
+    """
+    本地音乐库索引，持久化保存 视频ID/链接、标题、歌名、歌手 与本地文件的对应关系，
+    重复请求无需联网或调用模型即可命中；总大小超出预算时淘汰最久未使用的文件。
+    """
+
+    def __init__(self, music_dir: str = MUSIC_DIR, max_bytes: int = MUSIC_LIBRARY_MAX_BYTES):
+        self.music_dir = music_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(music_dir):
+            os.makedirs(music_dir)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(music_dir, 'library.db'), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "video_id TEXT PRIMARY KEY, url TEXT NOT NULL, title TEXT, title_norm TEXT, "
+                "song TEXT, song_norm TEXT DEFAULT '', artist TEXT, artist_norm TEXT DEFAULT '', "
+                "path TEXT NOT NULL, duration REAL, sha256 TEXT, size INTEGER, "
+                "added_at REAL, last_access REAL);"
+                "CREATE INDEX IF NOT EXISTS idx_tracks_song ON tracks (song_norm);"
+                "CREATE INDEX IF NOT EXISTS idx_tracks_path ON tracks (path);"
+                "CREATE INDEX IF NOT EXISTS idx_tracks_access ON tracks (last_access);"
+            )
+            self._conn.commit()
+
+    def _valid(self, row):
+        """校验文件仍然存在，不存在则删除索引记录"""
+        if row is None:
+            return None
+        if not os.path.exists(row['path']):
+            self._conn.execute("DELETE FROM tracks WHERE video_id = ?", (row['video_id'],))
+            self._conn.commit()
+            return None
+        self._conn.execute("UPDATE tracks SET last_access = ? WHERE video_id = ?", (time.time(), row['video_id']))
+        self._conn.commit()
+        return dict(row)
+
+    def find_by_url(self, url: str):
+        """按视频链接(BV号)查找已下载的文件"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM tracks WHERE video_id = ?",
+                                     (extract_video_id(url),)).fetchone()
+            return self._valid(row)
+
+    def match_query(self, text: str):
+        """
+        在用户请求文本中查找已知歌名，只在请求能被完整解释时返回匹配记录：
+        去掉歌名、歌手(标记了歌手的记录要求请求中出现歌手名)和客套用词后不能再有其他内容，
+        否则(如提到另一位歌手、请求多首歌、含否定)返回 None 交给分析流程。
+        """
+        query = normalize_title(text)
+        if not query:
+            return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM tracks WHERE length(song_norm) >= ? AND instr(?, song_norm) > 0 "
+                "AND (artist_norm = '' OR instr(?, artist_norm) > 0) "
+                "ORDER BY length(song_norm) DESC, artist_norm != '' DESC, last_access DESC",
+                (MIN_SONG_CHARS, query, query),
+            ).fetchall()
+            for row in rows:
+                rest = query.replace(row['song_norm'], '', 1)
+                if row['artist_norm']:
+                    rest = rest.replace(row['artist_norm'], '', 1)
+                if not FILLER_PATTERN.sub('', rest):
+                    return self._valid(row)
+            return None
+
+    def add(self, url: str, title: str, path: str, duration: float = None):
+        """登记新下载的文件并按大小预算淘汰旧文件"""
+        now = time.time()
+        size = os.path.getsize(path)
+        sha256 = file_sha256(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO tracks (video_id, url, title, title_norm, path, duration, sha256, size, added_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(video_id) DO UPDATE SET url = excluded.url, title = excluded.title, "
+                "title_norm = excluded.title_norm, path = excluded.path, duration = excluded.duration, "
+                "sha256 = excluded.sha256, size = excluded.size, last_access = excluded.last_access",
+                (extract_video_id(url), url, title, normalize_title(title), path, duration, sha256, size, now, now),
+            )
+            self._conn.commit()
+            self._evict(keep_path=path)
+
+    def tag(self, path: str, song: str, artist: str = None):
+        """为已登记的文件补充歌名与歌手，用于后续按请求文本直接命中"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tracks SET song = ?, song_norm = ?, artist = ?, artist_norm = ? WHERE path = ?",
+                (song, normalize_title(song), artist, normalize_title(artist), path),
+            )
+            self._conn.commit()
+
+    def _evict(self, keep_path: str = None):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tracks").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT video_id, path, size FROM tracks ORDER BY last_access").fetchall()
+        for row in rows:
+            if total <= self.max_bytes:
+                break
+            if row['path'] == keep_path:
+                continue
+            try:
+                os.remove(row['path'])
+            except OSError:
+                pass
+            self._conn.execute("DELETE FROM tracks WHERE video_id = ?", (row['video_id'],))
+            total -= row['size'] or 0
+        self._conn.commit()
+
+
+music_library = MusicLibrary()
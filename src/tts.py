@@ -1,27 +1,378 @@
 import os
 import re
+import queue
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+import torch
+import torchaudio
 from f5_tts.api import F5TTS
+from f5_tts.model.utils import convert_char_to_pinyin
+from f5_tts.infer.utils_infer import (
+    preprocess_ref_audio_text,
+    chunk_text,
+    target_rms,
+    target_sample_rate,
+    hop_length,
+    nfe_step,
+    cfg_strength,
+    sway_sampling_coef,
+    cross_fade_duration,
+)
+
+# 句末标点：遇到这些字符即可切分出一个句子送去合成
+SENTENCE_PATTERN = re.compile(r'[。！？；!?;\n]+')
+THINK_START = "<think>"
+THINK_END = "</think>"
+
+# 可选参考人声：名称 -> (参考音频文件, 参考音频对应文本)
+DEFAULT_VOICE = "taiyi"
+REFERENCE_VOICES = {
+    DEFAULT_VOICE: (os.path.join(os.path.dirname(__file__), "basic_ref_zh.wav"), "对，这就是我，万人敬仰的太乙真人。"),
+}
+
+
+class SentenceSplitter:
+    """
+    增量地把文本流按中文标点切分为句子，并过滤 <think>...</think> 之间的推理内容。
+    过短的片段会与后续文本合并，避免对零碎文本单独合成。
+    """
+
+    def __init__(self, min_length: int = 4):
+        self.min_length = min_length
+        self.buffer = ""
+        self.in_think = False
+        self.think_from = 0
+
+    def _strip_think(self):
+        while True:
+            if self.in_think:
+                end = self.buffer.find(THINK_END, self.think_from)
+                if end < 0:
+                    # 推理内容直接丢弃，只保留可能被截断的结束标签
+                    self.buffer = self.buffer[:self.think_from] + self.buffer[self.think_from:][-len(THINK_END):]
+                    return
+                self.buffer = self.buffer[:self.think_from] + self.buffer[end + len(THINK_END):]
+                self.in_think = False
+            start = self.buffer.find(THINK_START)
+            if start < 0:
+                return
+            self.in_think = True
+            self.think_from = start
+            self.buffer = self.buffer[:start] + self.buffer[start + len(THINK_START):]
+
+    def feed(self, text: str) -> list:
+        """追加文本片段，返回已经完整的句子列表"""
+        self.buffer += text
+        self._strip_think()
+        if self.in_think:
+            return []
+        sentences = []
+        start = 0
+        for match in SENTENCE_PATTERN.finditer(self.buffer):
+            sentence = self.buffer[start:match.end()].strip()
+            if len(sentence) >= self.min_length:
+                sentences.append(sentence)
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> list:
+        """文本流结束时取出剩余的内容"""
+        rest = "" if self.in_think else self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+
+class SpeechPipeline:
+    """
+    句子级流水线语音合成：文本片段不断送入，按句切分后由后台线程逐句合成，
+    调用方可以在文本仍在生成时就取出已经合成好的语音片段。
+    """
+
+    def __init__(self, tts: "TTS", voice: str = DEFAULT_VOICE):
+        self.tts = tts
+        self.voice = voice
+        self.splitter = SentenceSplitter()
+        self._sentences = queue.Queue()
+        self._chunks = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            sentence = self._sentences.get()
+            if sentence is None:
+                self._chunks.put(None)
+                return
+            try:
+                self._chunks.put(self.tts.generate(sentence, voice=self.voice))
+            except Exception:
+                logging.exception(f"语音合成失败: {sentence}")
+
+    def feed(self, text: str):
+        """送入新的文本片段"""
+        for sentence in self.splitter.feed(text):
+            self._sentences.put(sentence)
+
+    def close(self):
+        """文本流结束，送出剩余文本"""
+        if self._closed:
+            return
+        self._closed = True
+        for sentence in self.splitter.flush():
+            self._sentences.put(sentence)
+        self._sentences.put(None)
+
+    def next_chunk(self):
+        """非阻塞地取出一个已合成的语音片段，没有则返回 None"""
+        try:
+            chunk = self._chunks.get_nowait()
+        except queue.Empty:
+            return None
+        if chunk is None:
+            # 结束标记放回去，交给 remaining_chunks 处理
+            self._chunks.put(None)
+        return chunk
+
+    def remaining_chunks(self):
+        """关闭流水线并依次阻塞产出剩余的语音片段"""
+        self.close()
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+
+class ReferenceVoice:
+    """
+    预处理完成的参考人声，常驻内存：
+    包括归一化、重采样后的梅尔特征，参考文本及其拼音序列，推理时直接作为条件输入。
+    """
+
+    def __init__(self, name: str, ref_file: str, ref_text: str, tts: F5TTS):
+        self.name = name
+        ref_file, self.ref_text = preprocess_ref_audio_text(ref_file, ref_text, show_info=logging.debug)
+        audio, sr = torchaudio.load(ref_file)
+        if audio.shape[0] > 1:
+            audio = torch.mean(audio, dim=0, keepdim=True)
+        self.rms = torch.sqrt(torch.mean(torch.square(audio))).item()
+        if self.rms < target_rms:
+            audio = audio * target_rms / self.rms
+        if sr != target_sample_rate:
+            audio = torchaudio.transforms.Resample(sr, target_sample_rate)(audio)
+        audio = audio.to(tts.device)
+        with torch.inference_mode():
+            # (1, n_mels, 帧数) -> (1, 帧数, n_mels)，与 CFM.sample 的条件输入格式一致
+            self.mel = tts.ema_model.mel_spec(audio).permute(0, 2, 1)
+        self.ref_pinyin = convert_char_to_pinyin([self.ref_text])[0]
+        self.ref_text_bytes = len(self.ref_text.encode("utf-8"))
+        self.ref_audio_len = audio.shape[-1] // hop_length
+        ref_seconds = audio.shape[-1] / target_sample_rate
+        self.max_chars = int(self.ref_text_bytes / ref_seconds * (22 - ref_seconds))
+
+
+def cross_fade(waves: list, sample_rate: int) -> np.ndarray:
+    """按 cross_fade_duration 交叉淡入淡出拼接多段语音"""
+    final_wave = waves[0]
+    fade_samples = int(cross_fade_duration * sample_rate)
+    for wave in waves[1:]:
+        samples = min(fade_samples, len(final_wave), len(wave))
+        if samples <= 0:
+            final_wave = np.concatenate([final_wave, wave])
+            continue
+        fade_out = np.linspace(1, 0, samples)
+        fade_in = np.linspace(0, 1, samples)
+        overlap = final_wave[-samples:] * fade_out + wave[:samples] * fade_in
+        final_wave = np.concatenate([final_wave[:-samples], overlap, wave[samples:]])
+    return final_wave
+
+
+def split_sentences(text: str) -> list:
+    """把完整文本按句末标点切分为句子"""
+    splitter = SentenceSplitter(min_length=1)
+    return splitter.feed(text) + splitter.flush()
+
+
+def normalize_text(text: str) -> str:
+    """归一化文本，使全半角、空白不同的相同内容命中同一缓存"""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", text))
+
+
+class TTSAudioCache:
+    """
+    内容寻址的语音缓存，键为 归一化文本/人声/语速/模型检查点 的哈希。
+    内存与磁盘两级存储，各自按字节预算做 LRU 淘汰，并统计命中情况。
+    """
+
+    def __init__(self, cache_dir: str, memory_budget: int = 64 * 1024 * 1024, disk_budget: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # 磁盘条目按最近访问时间排序，启动时以文件修改时间恢复顺序
+        files = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".npz")]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        self._disk = OrderedDict((entry.name[:-4], entry.stat().st_size) for entry in files)
+        self._disk_bytes = sum(self._disk.values())
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, voice: str, speed: float, checkpoint: str) -> str:
+        raw = "\x1f".join([normalize_text(text), voice, f"{speed:.3f}", checkpoint])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _remember(self, key: str, sr: int, wav: np.ndarray):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = (sr, wav)
+        self._memory_bytes += wav.nbytes
+        while self._memory_bytes > self.memory_budget and len(self._memory) > 1:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def get(self, key: str):
+        """查找缓存，返回 (采样率, 语音数据)，未命中返回 None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            if key not in self._disk:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with np.load(path) as data:
+                    sr, wav = int(data["sr"]), data["wav"]
+                os.utime(path)
+            except OSError:
+                self._disk_bytes -= self._disk.pop(key)
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+            self._remember(key, sr, wav)
+            self.disk_hits += 1
+            return sr, wav
+
+    def put(self, key: str, sr: int, wav: np.ndarray):
+        """写入缓存，同时落盘并按磁盘预算淘汰最久未使用的条目"""
+        wav = np.asarray(wav, dtype=np.float32)
+        with self._lock:
+            self._remember(key, sr, wav)
+            if key in self._disk:
+                return
+            path = self._path(key)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, sr=sr, wav=wav)
+            os.replace(tmp_path, path)
+            self._disk[key] = os.path.getsize(path)
+            self._disk_bytes += self._disk[key]
+            while self._disk_bytes > self.disk_budget and len(self._disk) > 1:
+                evicted, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
 
 
 class TTS:
-    def __init__(self):
+    def __init__(self, voices: dict = None):
         vocab_path = os.path.join(os.path.dirname(__file__), "vocab.txt")
         model_path = os.path.join(os.path.dirname(__file__), "model_1200000.safetensors")
         self.tts = F5TTS(
             vocab_file=vocab_path,
             ckpt_file=model_path
         )
+        self._infer_lock = threading.Lock()
+        # 模型检查点标识参与缓存键，更换模型文件后旧缓存自然失效
+        model_stat = os.stat(model_path)
+        self.checkpoint = f"{os.path.basename(model_path)}:{model_stat.st_size}:{int(model_stat.st_mtime)}"
+        self.cache = TTSAudioCache(os.path.abspath(os.path.join(os.path.dirname(__file__), '../tts_cache_dir')))
+        # 启动时一次性预处理所有参考人声，请求时按名称直接选用
+        self.voices = {
+            name: ReferenceVoice(name, ref_file, ref_text, self.tts)
+            for name, (ref_file, ref_text) in (voices or REFERENCE_VOICES).items()
+        }
 
-    def generate(self, text: str):
+    def _infer(self, voice: ReferenceVoice, text: str, speed: float) -> np.ndarray:
         """
-        根据输入文本生成语音，返回采样率和语音数据
+        使用预处理好的参考人声条件直接采样并声码，避免每次重新处理参考音频。
+        这里与 ReferenceVoice 依赖 F5TTS 的内部属性(ema_model、vocoder、mel_spec_type、device)
+        和 utils_infer 中的常量，按 requirements.txt 固定的 f5-tts==0.6.2 编写，升级时需要重新核对。
         """
-        wav_path = os.path.join(os.path.dirname(__file__), "basic_ref_zh.wav")
-        wav, sr, spect = self.tts.infer(
-            ref_file=wav_path,
-            ref_text="对，这就是我，万人敬仰的太乙真人。",
-            gen_text=text,
-            seed=-1,
-            speed=1.5
-        )
-        return sr, wav
+        waves = []
+        for gen_text in chunk_text(text, max_chars=voice.max_chars):
+            pinyin = voice.ref_pinyin + convert_char_to_pinyin([gen_text])[0]
+            gen_len = int(voice.ref_audio_len / voice.ref_text_bytes * len(gen_text.encode("utf-8")) / speed)
+            with torch.inference_mode():
+                generated, _ = self.tts.ema_model.sample(
+                    cond=voice.mel,
+                    text=[pinyin],
+                    duration=voice.ref_audio_len + gen_len,
+                    steps=nfe_step,
+                    cfg_strength=cfg_strength,
+                    sway_sampling_coef=sway_sampling_coef,
+                )
+                generated = generated.to(torch.float32)[:, voice.ref_audio_len:, :].permute(0, 2, 1)
+                if self.tts.mel_spec_type == "vocos":
+                    wave = self.tts.vocoder.decode(generated)
+                else:
+                    wave = self.tts.vocoder(generated)
+            if voice.rms < target_rms:
+                wave = wave * voice.rms / target_rms
+            waves.append(wave.squeeze().cpu().numpy())
+        return cross_fade(waves, target_sample_rate)
+
+    def generate(self, text: str, voice: str = DEFAULT_VOICE, speed: float = 1.5):
+        """
+        根据输入文本和参考人声名称生成语音，返回采样率和语音数据。
+        按句查询缓存，只合成未缓存过的句子。
+        """
+        waves = []
+        for sentence in split_sentences(text):
+            key = self.cache.make_key(sentence, voice, speed, self.checkpoint)
+            cached = self.cache.get(key)
+            if cached is None:
+                with self._infer_lock:
+                    wav = self._infer(self.voices[voice], sentence, speed)
+                self.cache.put(key, target_sample_rate, wav)
+            else:
+                wav = cached[1]
+            waves.append(wav)
+        if not waves:
+            return target_sample_rate, np.zeros(0, dtype=np.float32)
+        return target_sample_rate, cross_fade(waves, target_sample_rate)
+
+    def pipeline(self, voice: str = DEFAULT_VOICE) -> SpeechPipeline:
+        """创建一个句子级流水线合成会话"""
+        return SpeechPipeline(self, voice)